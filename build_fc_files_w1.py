@@ -14,32 +14,25 @@
 #
 import os
 import sys
-import numpy
 import importlib
-import subprocess
 
 # Local files
+from load_stack import load_stack
+import generate_geometry
 from ordered_stack import ordered_stack
-from generate_geometry import generate_one_wire_file
+from sweep_range import sweep_range
+from fc_args import build_parser, comma_list
+from generate_geometry import generate_one_wire_file, generate_files
+from run_fastercap import memoize_fastercap, fastercap_dir
 
-#--------------------------------------------------------------
-# Usage statement
-#--------------------------------------------------------------
-
-def usage():
-    print('Usage:  build_fc_files_w1.py <stack_def_file> [options]')
-    print('  Where [options] may be one or more of:')
-    print('     -metals=<metal>[,...]  (restrict wire type to one or more metals)')
-    print('     -conductors=<conductor>[,...] (restrict conductor type to one or more types)')
-    print('     -width=<start>,<stop>,<step> (wire width range, in microns)')
-    print('     -tol[erance]=<value>         (FasterCap tolerance)')
-    print('     -file=<name>                 (output filename for results)')
+# Translation table for turning a width like 1.50 into "1p50" in filenames
+wspec_trans = str.maketrans('.', 'p')
 
 #--------------------------------------------------------------
 # The main routine
 #
 # build_fc_files_w1(stackupfile, metallist, condlist, widths,
-#	outfile, tolerance, verbose):
+#	outfile, tolerance, verbose, incremental):
 #
 # where:
 #	stackupfile = name of the script file with the metal
@@ -50,38 +43,40 @@ def usage():
 #	outfile = name of output file with results
 #	tolerance = initial tolerance to use for FasterCap
 #	verbose = diagnostic output level
+#	incremental = if True, do not regenerate FasterCap input
+#		files that are newer than the metal stack file
+#		and the geometry generator
 #--------------------------------------------------------------
 
-def build_fc_files_w1(stackupfile, metallist, condlist, widths, outfile, tolerance, verbose=0):
+def build_fc_files_w1(stackupfile, metallist, condlist, widths, outfile, tolerance, verbose=0, incremental=False):
 
-    use_default_width = True if not widths else False
+    use_default_width = True if widths is None or len(widths) == 0 else False
 
     #--------------------------------------------------------------
     # 1. Obtain the metal stack.  The metal stack file is in the
-    #    format of executable python, so use exec().
+    #    format of executable python (see load_stack.py).
     #--------------------------------------------------------------
 
     try:
-        locals = {}
-        exec(open(stackupfile, 'r').read(), None, locals)
+        stackvars = load_stack(stackupfile)
     except:
         print('Error:  No metal stack file ' + stackupfile + '!')
         return 1
 
     try:
-        process = locals['process']
+        process = stackvars['process']
     except:
         print('Warning:  Metal stack does not define process!')
         process = 'unknown'
 
     try:
-        layers = locals['layers']
+        layers = stackvars['layers']
     except:
         print('Error:  Metal stack does not define layers!')
         return 1
 
     try:
-        limits = locals['limits']
+        limits = stackvars['limits']
     except:
         print('Error:  Metal stack does not define limits!')
         return 1
@@ -92,15 +87,17 @@ def build_fc_files_w1(stackupfile, metallist, condlist, widths, outfile, toleran
 
     # "metals" is a reorganization of the full stack list to include
     # just the metal layers and their heights and thicknesses.
+    # "lower_metals" is a dictionary giving, for each metal, the list
+    # of metals below it in the stack.
 
     metals = []
+    substrates = []
+    lower_metals = {}
     for lname, layer in layers.items():
         if layer[0] == 'm':
+            lower_metals[lname] = metals.copy()
             metals.append(lname)
-
-    substrates = []
-    for lname, layer in layers.items():
-        if layer[0] == 'd':
+        elif layer[0] == 'd':
             substrates.append(lname)
 
     # Check options
@@ -130,20 +127,26 @@ def build_fc_files_w1(stackupfile, metallist, condlist, widths, outfile, toleran
         print('   Wire widths = ' + str(widths))
         print('')
 
+    # Each FasterCap input file and the (metal, conductor, width)
+    # parameters it was generated from.
     filelist = []
+    fileparams = []
+    tasks = []
 
     # Make sure the working directory exists
-    os.makedirs(process + '/fastercap_files/w1', exist_ok=True)
+    filedir = fastercap_dir(process, 'w1')
+    os.makedirs(filedir, exist_ok=True)
+
+    # Input files are out of date if older than either the stack
+    # file or the geometry generator.
+    if incremental:
+        srctime = max(os.path.getmtime(stackupfile),
+		os.path.getmtime(generate_geometry.__file__))
 
     for metal in metallist:
 
         if condlist == []:
-            conductors = substrates.copy()
-            for lname, layer in layers.items():
-                if lname == metal:
-                    break
-                elif layer[0] == 'm':
-                    conductors.append(lname)
+            conductors = substrates + lower_metals[metal]
         else:
             # Note:  This may need to be restricted
             conductors = condlist.copy()
@@ -153,7 +156,7 @@ def build_fc_files_w1(stackupfile, metallist, condlist, widths, outfile, toleran
             wstart = minwidth
             wstop = 10 * minwidth + 0.5 * minwidth
             wstep = 9 * minwidth
-            widths = list(numpy.arange(wstart, wstop, wstep))
+            widths = sweep_range(wstart, wstop, wstep)
 
         for conductor in conductors:
             # Poly to diff is a transistor gate and is not a parasitic.
@@ -172,10 +175,17 @@ def build_fc_files_w1(stackupfile, metallist, condlist, widths, outfile, toleran
                 print('')
 
             for width in widths:
-                wspec = "{:.2f}".format(width).replace('.', 'p')
-                filename = process + '/fastercap_files/w1/' + metal + '_' + conductor + '_w_' + wspec + '.lst'
-                generate_one_wire_file(filename, conductor, metal, width, pstack)
+                wspec = f'{width:.2f}'.translate(wspec_trans)
+                filename = filedir + '/' + metal + '_' + conductor + '_w_' + wspec + '.lst'
                 filelist.append(filename)
+                fileparams.append((metal, conductor, width))
+                if incremental and os.path.isfile(filename):
+                    if os.path.getmtime(filename) > srctime:
+                        continue
+                tasks.append((filename, conductor, metal, width, pstack))
+
+    # Write out all of the FasterCap input files
+    generate_files(generate_one_wire_file, tasks)
 
     #--------------------------------------------------------------
     # 3. Simulate with fastercap
@@ -185,67 +195,17 @@ def build_fc_files_w1(stackupfile, metallist, condlist, widths, outfile, toleran
         print('Tolerance set to zero;  skipping FasterCap run')
         return 0
 
-    fastercapexec = os.getenv('FASTERCAP_EXEC')
-    if not fastercapexec:
-        fastercapexec = 'FasterCap'
-
     presults = []
 
-    for file in filelist:
-        loctol = tolerance
-        print('Running FasterCap on input file ' + file)
-        done = False
-        while not done: 
-            tolspec = "-a{:.3f}".format(loctol)
-            try:
-                proc = subprocess.run([fastercapexec, '-b', file, tolspec],
-			stdin = subprocess.DEVNULL,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,
-			universal_newlines = True,
-                	timeout = 30)
-            except subprocess.TimeoutExpired:
-                if loctol > 0.1:
-                    print('ERROR:  Failing with high tolerance;  bailing.')
-                    break
-                loctol *= 2
-                if verbose > 0:
-                    print('Trying again with tolerance = ' + '{:.3f}'.format(loctol))
-            else:
-                done = True
-                if loctol > 0.01:
-                    print('WARNING:  High tolerance value (' + tolspec + ') used.')
-
-        if proc.stdout:
-            if verbose > 1:
-                print('Diagnostic output from FasterCap:')
-            for line in proc.stdout.splitlines():
-                if verbose > 1:
-                    print(line)
-                if 'g1_' in line:
-                    g1line = line.split()
-                    g0 = float(g1line[1])
-
-        if proc.stderr:
-            print('Error message output from FasterCap:')
-            for line in proc.stderr.splitlines():
-                print(line)
-
-        if proc.returncode != 0:
-            print('ERROR:  FasterCap exited with status ' + str(proc.returncode))
-
-        if done:
-            csub = g0
+    for file, (metal, conductor, width) in zip(filelist, fileparams):
+        gmatrix = memoize_fastercap(file, tolerance, verbose)
+
+        if gmatrix:
+            csub = gmatrix[0][0]
             ssub = "{:.5g}".format(csub)
             print('Result:  Csub=' + ssub)
 
             # Add to results
-            fileroot = os.path.splitext(file)[0]
-            filename = os.path.split(fileroot)[-1]
-            values = filename.split('_')
-            metal = values[0]
-            conductor = values[1]
-            width = float(values[3].replace('p', '.'))
             presults.append([metal, conductor, width, csub])
 
     #--------------------------------------------------------------
@@ -256,6 +216,16 @@ def build_fc_files_w1(stackupfile, metallist, condlist, widths, outfile, toleran
         print('No results to save or print.')
         return 0
 
+    # Format all of the results once, for both the output file
+    # and the terminal.
+    results = ''
+    for presult in presults:
+        metal = presult[0]
+        conductor = presult[1]
+        swidth = "{:.4f}".format(presult[2])
+        ssub = "{:.5g}".format(presult[3])
+        results += metal + ' ' + conductor + ' ' + swidth + ' ' + ssub + '\n'
+
     # Make sure the output directory exists
     if outfile:
         outdir = os.path.split(outfile)[0]
@@ -263,21 +233,11 @@ def build_fc_files_w1(stackupfile, metallist, condlist, widths, outfile, toleran
             os.makedirs(outdir, exist_ok=True)
 
         with open(outfile, 'w') as ofile:
-            for presult in presults:
-                metal = presult[0]
-                conductor = presult[1]
-                swidth = "{:.4f}".format(presult[2])
-                ssub = "{:.5g}".format(presult[3])
-                print(metal + ' ' + conductor + ' ' + swidth + ' ' + ssub, file=ofile)
+            ofile.write(results)
 
     # Also print results to the terminal
     print('Results:')
-    for presult in presults:
-        metal = presult[0]
-        conductor = presult[1]
-        swidth = "{:.4f}".format(presult[2])
-        ssub = "{:.5g}".format(presult[3])
-        print(metal + ' ' + conductor + ' ' + swidth + ' ' + ssub)
+    print(results, end='')
 
     return 0
 
@@ -287,90 +247,20 @@ def build_fc_files_w1(stackupfile, metallist, condlist, widths, outfile, toleran
 
 if __name__ == '__main__':
 
-    options = []
-    arguments = []
-    for item in sys.argv[1:]:
-        if item.find('-', 0) == 0:
-            options.append(item)
-        else:
-            arguments.append(item)
-
-    if len(arguments) != 1:
-        print('Argument length is ' + str(len(arguments)))
-        usage()
-        sys.exit(1)
-
-    metallist = []
-    condlist = []
-    use_default_width = True
-    wstart = 0
-    wstop = 0
-    wstep = 0
-    outfile = None
-    tolerance = 0.01
-    verbose = 0
-
-    for option in options:
-        tokens = option.split('=')
-        if len(tokens) != 2:
-            print('Error:  Option "' + option + '":  Option must be in form "-key=<value>".')
-            usage()
-            continue
-        if tokens[0] == '-file':
-            outfile = tokens[1]
-        elif tokens[0] == '-verbose':
-            try:
-                verbose = int(tokens[1])
-            except:
-                print('Error:  Verbose level "' + tokens[1] + '" is not numeric.')
-                continue
-        elif tokens[0] == '-tol' or tokens[0] == '-tolerance':
-            try:
-                tolerance = float(tokens[1])
-            except:
-                print('Error:  Tolerance "' + tokens[1] + '" is not numeric.')
-                continue
-        elif tokens[0] == '-metals':
-            metallist = tokens[1].split(',')
-        elif tokens[0] == '-conductors':
-            condlist = tokens[1].split(',')
-        elif tokens[0] == '-width':
-            rangelist = tokens[1].split(',')
-            if len(rangelist) != 3:
-                print('Error:  Wire width needs three comma-separated values')
-                usage()
-                continue
-            optstr = rangelist[0].replace('um','')
-            try:
-                wstart = float(optstr)
-            except:
-                print('Error:  Wire width start value "' + optstr + '" is not numeric.')
-                continue
-            optstr = rangelist[1].replace('um','')
-            try:
-                wstop = float(optstr)
-            except:
-                print('Error:  Wire width end value "' + optstr + '" is not numeric.')
-                continue
-            optstr = rangelist[2].replace('um','')
-            try:
-                wstep = float(optstr)
-            except:
-                print('Error:  Wire width step value "' + optstr + '" is not numeric.')
-                continue
-            use_default_width = False
-        else:
-            print('Error:  Unknown option "' + option + '"')
-            usage()
-            continue
+    parser = build_parser('build_fc_files_w1.py')
+    parser.add_argument('-conductors', metavar='<conductor>[,...]', type=comma_list, default=[],
+		help='restrict conductor type to one or more types')
+    parser.add_argument('-incremental', action='store_true',
+		help='keep input files newer than the stack file')
+    args = parser.parse_args()
 
     # Call the main routine
 
-    if use_default_width:
-        widths = None
+    if args.width:
+        widths = sweep_range(*args.width)
     else:
-        widths = list(numpy.arange(wstart, wstop, wstep))
+        widths = None
 
-    rval = build_fc_files_w1(arguments[0], metallist, condlist, widths, outfile, tolerance, verbose)
+    rval = build_fc_files_w1(args.stackupfile, args.metals, args.conductors, widths,
+		args.outfile, args.tolerance, args.verbose, args.incremental)
     sys.exit(rval)
-
@@ -14,12 +14,13 @@
 #
 import os
 import sys
-import numpy
-import subprocess
 
 # Local files
+from load_stack import load_stack
 from ordered_stack import ordered_stack
-from generate_geometry import generate_1wire_2plane_file
+from sweep_range import sweep_range
+from generate_geometry import generate_1wire_2plane_file, generate_files
+from run_fastercap import run_fastercap_adaptive, fastercap_dir
 
 #--------------------------------------------------------------
 # Usage statement
@@ -33,13 +34,14 @@ def usage():
     print('     -sub[strate]=<substrate> (substrate type)')
     print('     -width=<start>,<stop>,<step> (wire width range, in microns)')
     print('     -tol[erance]=<value>         (FasterCap tolerance)')
+    print('     -adaptive=<value>            (run first with this looser tolerance)')
     print('     -file=<name>                 (output filename for results)')
 
 #--------------------------------------------------------------
 # The main routine
 #
 # build_fc_files_w1n(stackupfile, metallist, condlist, widths,
-#       outfile, tolerance, verbose):
+#       outfile, tolerance, verbose, adaptive):
 #
 # where:
 #       stackupfile = name of the script file with the metal
@@ -50,38 +52,41 @@ def usage():
 #       outfile = name of output file with results
 #       tolerance = initial tolerance to use for FasterCap
 #       verbose = diagnostic output level
+#       adaptive = if greater than tolerance, run all files first
+#               with this looser tolerance, and re-run only the
+#               files that need it with tolerance (see
+#               run_fastercap_adaptive() in run_fastercap.py)
 #--------------------------------------------------------------
 
-def build_fc_files_w1n(stackupfile, metallist, condlist, widths, outfile, tolerance, verbose=0):
+def build_fc_files_w1n(stackupfile, metallist, condlist, widths, outfile, tolerance, verbose=0, adaptive=0):
 
-    use_default_width = True if not widths else False
+    use_default_width = True if widths is None or len(widths) == 0 else False
 
     #--------------------------------------------------------------
     # Obtain the metal stack.  The metal stack file is in the
-    # format of executable python, so use exec().
+    # format of executable python (see load_stack.py).
     #--------------------------------------------------------------
 
     try:
-        locals = {}
-        exec(open(stackupfile, 'r').read(), None, locals)
+        stackvars = load_stack(stackupfile)
     except:
         print('Error:  No metal stack file ' + stackupfile + '!')
         return 1
 
     try:
-        process = locals['process']
+        process = stackvars['process']
     except:
         print('Warning:  Metal stack does not define process!')
         process = 'unknown'
 
     try:
-        layers = locals['layers']
+        layers = stackvars['layers']
     except:
         print('Error:  Metal stack does not define layers!')
         return 1
 
     try:
-        limits = locals['limits']
+        limits = stackvars['limits']
     except:
         print('Error:  Metal stack does not define limits!')
         return 1
@@ -133,10 +138,21 @@ def build_fc_files_w1n(stackupfile, metallist, condlist, widths, outfile, tolera
         print('   Wire widths = ' + str(widths))
         print('')
 
+    # Each FasterCap input file and the (metal, conductor, width)
+    # parameters it was generated from.
     filelist = []
+    fileparams = []
+    filenames = set()
+    tasks = []
 
     # Make sure the working directory exists
-    os.makedirs(process + '/fastercap_files/w1n', exist_ok=True)
+    filedir = fastercap_dir(process, 'w1n')
+    os.makedirs(filedir, exist_ok=True)
+
+    # The stack depends only on which metals are present, not on their
+    # order, so it is shared between (metal, conductor) and (conductor,
+    # metal), which both appear when the wire and shield lists overlap.
+    pstacks = {}
 
     # Since this calculation is for fringing fields from a wire upward
     # to a layer above, do this only for metals up to but not including
@@ -148,7 +164,7 @@ def build_fc_files_w1n(stackupfile, metallist, condlist, widths, outfile, tolera
             wstart = minwidth
             wstop = 10 * minwidth + 0.5 * minwidth
             wstep = 9 * minwidth
-            widths = list(numpy.arange(wstart, wstop, wstep))
+            widths = sweep_range(wstart, wstop, wstep)
 
         # "conductors" in this file represents the metal above the
         # wire structure under test, so reverse the layers and
@@ -166,7 +182,10 @@ def build_fc_files_w1n(stackupfile, metallist, condlist, widths, outfile, tolera
         for conductor in conductors:
             # Generate the stack for this particular combination of
             # reference conductor and metal
-            pstack = ordered_stack(substrate, [metal, conductor], layers)
+            stackkey = frozenset([metal, conductor])
+            if stackkey not in pstacks:
+                pstacks[stackkey] = ordered_stack(substrate, [metal, conductor], layers)
+            pstack = pstacks[stackkey]
 
             # (Diagnostic) Print out the stack
             if verbose > 1:
@@ -177,9 +196,17 @@ def build_fc_files_w1n(stackupfile, metallist, condlist, widths, outfile, tolera
 
             for width in widths:
                 wspec = "{:.2f}".format(width).replace('.', 'p')
-                filename = process + '/fastercap_files/w1n/' + metal + '_' + conductor + '_w_' + wspec + '.lst'
-                generate_1wire_2plane_file(filename, substrate, conductor, metal, width, pstack)
+                filename = filedir + '/' + metal + '_' + conductor + '_w_' + wspec + '.lst'
+                # A repeated wire or shield metal gives a repeated
+                # file, which only needs to be written once.
+                if filename not in filenames:
+                    filenames.add(filename)
+                    tasks.append((filename, substrate, conductor, metal, width, pstack))
                 filelist.append(filename)
+                fileparams.append((metal, conductor, width))
+
+    # Write out all of the FasterCap input files
+    generate_files(generate_1wire_2plane_file, tasks)
 
     #--------------------------------------------------------------
     # Simulate with fastercap
@@ -189,75 +216,53 @@ def build_fc_files_w1n(stackupfile, metallist, condlist, widths, outfile, tolera
         print('Tolerance set to zero;  skipping FasterCap run')
         return 0
 
-    fastercapexec = os.getenv('FASTERCAP_EXEC')
-    if not fastercapexec:
-        fastercapexec = 'FasterCap'
+    # Results are written to "<outfile>.part" as they come in, so
+    # that the results so far are kept if the run is interrupted.
+    # When the run is complete, the results are written again in
+    # sweep order, and the file is renamed to "outfile" (note that
+    # compute_coefficients.py takes an existing "outfile" to mean
+    # that the run was already done).
 
-    presults = []
+    if outfile:
+        # Make sure the output directory exists
+        outdir = os.path.split(outfile)[0]
+        if outdir != '':
+            os.makedirs(outdir, exist_ok=True)
+        ofile = open(outfile + '.part', 'w')
+    else:
+        ofile = None
 
-    for file in filelist:
-        loctol = tolerance
-        print('Running FasterCap on input file ' + file)
-        done = False
-        while not done:
-            tolspec = "-a{:.3f}".format(loctol)
-            try:
-                proc = subprocess.run([fastercapexec, '-b', file, tolspec],
-			stdin = subprocess.DEVNULL,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,
-			universal_newlines = True,
-                	timeout = 30)
-            except subprocess.TimeoutExpired:
-                if loctol > 0.1:
-                    print('ERROR:  Failing with high tolerance;  bailing.')
-                    break
-                loctol *= 2
-                if verbose > 0:
-                    print('Trying again with tolerance = ' + '{:.3f}'.format(loctol))
-            else:
-                done = True
-                if loctol > 0.01:
-                    print('WARNING:  High tolerance value (' + tolspec + ') used.')
-
-        if proc.stdout:
-            if verbose > 1:
-                print('Diagnostic output from FasterCap:')
-            for line in proc.stdout.splitlines():
-                if verbose > 1:
-                    print(line)
-                if 'g1_' in line:
-                    g1line = line.split()
-                    g00 = float(g1line[1])
-                    g01 = float(g1line[2])
-                elif 'g2_' in line:
-                    g2line = line.split()
-                    g10 = float(g2line[1])
-                    g11 = float(g2line[2])
-
-        if proc.stderr:
-            print('Error message output from FasterCap:')
-            for line in proc.stderr.splitlines():
-                print(line)
-
-        if proc.returncode != 0:
-            print('ERROR:  FasterCap exited with status ' + str(proc.returncode))
-
-        if done:
+    presults = {}
+
+    def save_result(i, gmatrix):
+        if gmatrix:
+            metal, conductor, width = fileparams[i]
             # Note:  Where g01 != g10, use the average value.
             # ccoup = -(g01 + g10) / 2.0
-            ccoup = -g10
+            ccoup = -gmatrix[1][0]
             scoup = "{:.5g}".format(ccoup)
             print('Result:  Ccoup=' + scoup)
 
             # Add to results
-            fileroot = os.path.splitext(file)[0]
-            filename = os.path.split(fileroot)[-1]
-            values = filename.split('_')
-            metal = values[0]
-            conductor = values[1]
-            width = float(values[3].replace('p', '.'))
-            presults.append([metal, conductor, width, ccoup])
+            swidth = "{:.4f}".format(width)
+            presult = metal + ' ' + conductor + ' ' + swidth + ' ' + scoup
+            presults[i] = presult
+            if ofile:
+                print(presult, file=ofile, flush=True)
+
+    # Each FasterCap run is independent, so run them all at once
+    # (up to one per CPU), widest geometries first.  Results for
+    # each metal and conductor pair are checked as a group over
+    # the sweep of widths.
+
+    pairlist = [(metal, conductor) for metal, conductor, width in fileparams]
+    widthlist = [width for metal, conductor, width in fileparams]
+    try:
+        run_fastercap_adaptive(filelist, pairlist, tolerance, adaptive, verbose, widthlist,
+		callback=save_result)
+    finally:
+        if ofile:
+            ofile.close()
 
     #--------------------------------------------------------------
     # Save (and print) results
@@ -265,30 +270,20 @@ def build_fc_files_w1n(stackupfile, metallist, condlist, widths, outfile, tolera
 
     if len(presults) == 0:
         print('No results to save or print.')
+        if ofile:
+            os.remove(outfile + '.part')
         return 0
 
-    if outfile:
-        # Make sure the output directory exists
-        outdir = os.path.split(outfile)[0]
-        if outdir != '':
-            os.makedirs(outdir, exist_ok=True)
+    results = ''.join(presults[i] + '\n' for i in sorted(presults))
 
-        with open(outfile, 'w') as ofile:
-            for presult in presults:
-                metal = presult[0]
-                conductor = presult[1]
-                swidth = "{:.4f}".format(presult[2])
-                scoup = "{:.5g}".format(presult[3])
-                print(metal + ' ' + conductor + ' ' + swidth + ' ' + scoup, file=ofile)
+    if ofile:
+        with open(outfile + '.part', 'w') as ofile:
+            ofile.write(results)
+        os.replace(outfile + '.part', outfile)
 
     # Also print results to the terminal
     print('Results:')
-    for presult in presults:
-        metal = presult[0]
-        conductor = presult[1]
-        swidth = "{:.4f}".format(presult[2])
-        scoup = "{:.5g}".format(presult[3])
-        print(metal + ' ' + conductor + ' ' + swidth + ' ' + scoup)
+    print(results, end='')
 
     return 0
 
@@ -321,6 +316,7 @@ if __name__ == '__main__':
     outfile = None
     verbose = 0
     tolerance = 0.01
+    adaptive = 0
 
     for option in options:
         tokens = option.split('=')
@@ -342,6 +338,12 @@ if __name__ == '__main__':
             except:
                 print('Error:  Tolerance "' + tokens[1] + '" is not numeric.')
                 continue
+        elif tokens[0] == '-adaptive':
+            try:
+                adaptive = float(tokens[1])
+            except:
+                print('Error:  Adaptive tolerance "' + tokens[1] + '" is not numeric.')
+                continue
         elif tokens[0] == '-metals':
             metallist = tokens[1].split(',')
         elif tokens[0] == '-shields':
@@ -383,8 +385,8 @@ if __name__ == '__main__':
     if use_default_width:
         widths = None
     else:
-        widths = list(numpy.arange(wstart, wstop, wstep))
+        widths = sweep_range(wstart, wstop, wstep)
 
-    rval = build_fc_files_w1n(arguments[0], metallist, condlist, widths, outfile, tolerance, verbose)
+    rval = build_fc_files_w1n(arguments[0], metallist, condlist, widths, outfile, tolerance, verbose, adaptive)
     sys.exit(rval)
 
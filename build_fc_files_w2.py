@@ -15,12 +15,13 @@
 #
 import os
 import sys
-import numpy
-import subprocess
 
 # Local files
+from load_stack import load_stack
 from ordered_stack import ordered_stack
-from generate_geometry import generate_two_wire_file
+from sweep_range import sweep_range
+from generate_geometry import generate_two_wire_file, generate_files
+from run_fastercap import run_fastercap_batch, fastercap_dir
 
 #--------------------------------------------------------------
 # Usage statement
@@ -56,35 +57,34 @@ def usage():
 
 def build_fc_files_w2(stackupfile, metallist, condlist, widths, seps, outfile, tolerance, verbose=0):
 
-    use_default_width = True if not widths else False
-    use_default_sep = True if not seps else False
+    use_default_width = True if widths is None or len(widths) == 0 else False
+    use_default_sep = True if seps is None or len(seps) == 0 else False
 
     #--------------------------------------------------------------
     # Obtain the metal stack.  The metal stack file is in the
-    # format of executable python, so use exec().
+    # format of executable python (see load_stack.py).
     #--------------------------------------------------------------
 
     try:
-        locals = {}
-        exec(open(stackupfile, 'r').read(), None, locals)
+        stackvars = load_stack(stackupfile)
     except:
         print('Error:  No metal stack file ' + stackupfile + '!')
         return 1
 
     try:
-        process = locals['process']
+        process = stackvars['process']
     except:
         print('Warning:  Metal stack does not define process!')
         process = 'unknown'
 
     try:
-        layers = locals['layers']
+        layers = stackvars['layers']
     except:
         print('Error:  Metal stack does not define layers!')
         return 1
 
     try:
-        limits = locals['limits']
+        limits = stackvars['limits']
     except:
         print('Error:  Metal stack does not define limits!')
         return 1
@@ -94,29 +94,32 @@ def build_fc_files_w2(stackupfile, metallist, condlist, widths, seps, outfile, t
     #--------------------------------------------------------------
 
     # "metals" is a reorganization of the full stack list to include
-    # just the metal layers and their heights and thicknesses.
+    # just the metal layers and their heights and thicknesses, and
+    # "substrates" the ground plane (diffusion) layers.  Both are
+    # picked out in one pass over the stack.
 
     metals = []
+    substrates = []
     for lname, layer in layers.items():
         if layer[0] == 'm':
             metals.append(lname)
-
-    substrates = []
-    for lname, layer in layers.items():
-        if layer[0] == 'd':
+        elif layer[0] == 'd':
             substrates.append(lname)
 
     # Check options
 
-    for metal in metallist.copy():
-        if metal not in metals:
+    metalset = set(metals)
+    condset = metalset.union(substrates)
+
+    for metal in metallist:
+        if metal not in metalset:
             print('Error:  Wire metal "' + metal + '" is not in the stackup!')
-            metallist.remove(metal)
+    metallist = [metal for metal in metallist if metal in metalset]
 
-    for conductor in condlist.copy():
-        if conductor not in substrates and conductor not in metals:
+    for conductor in condlist:
+        if conductor not in condset:
             print('Error:  Substrate type "' + conductor + '" is not in the stackup!')
-            condlist.remove(conductor)
+    condlist = [conductor for conductor in condlist if conductor in condset]
 
     # Set default values if not specified in options
 
@@ -134,33 +137,44 @@ def build_fc_files_w2(stackupfile, metallist, condlist, widths, seps, outfile, t
         print('   Wire separations = ' + str(seps))
         print('')
 
+    # Each FasterCap input file and the (metal, conductor, width,
+    # separation) parameters it was generated from.
     filelist = []
+    fileparams = []
+    tasks = []
 
     # Make sure the working directory exists
-    os.makedirs(process + '/fastercap_files/w2', exist_ok=True)
+    filedir = fastercap_dir(process, 'w2')
+    os.makedirs(filedir, exist_ok=True)
 
     for metal in metallist:
 
+        # Poly to diff is a transistor gate and is not a parasitic.  Skip
+        # the metal entirely if that leaves no reference conductor.
+        conductors = [conductor for conductor in condlist if not ('poly' in metal and 'diff' in conductor)]
+        if conductors == []:
+            continue
+
         if use_default_width == True:
             minwidth = limits[metal][0]
             wstart = minwidth
             wstop = 10 * minwidth + 0.5 * minwidth
             wstep = 9 * minwidth
-            widths = list(numpy.arange(wstart, wstop, wstep))
+            widths = sweep_range(wstart, wstop, wstep)
 
         if use_default_sep == True:
             minsep = limits[metal][1]
             sstart = minsep
             sstop = 10 * minsep + 0.5 * minsep
             sstep = minsep
-            seps = list(numpy.arange(sstart, sstop, sstep))
+            seps = sweep_range(sstart, sstop, sstep)
 
-        for conductor in condlist:
-
-            # Poly to diff is a transistor gate and is not a parasitic.
-            if 'poly' in metal and 'diff' in conductor:
-                continue
+        # Filename tags for each width and separation, shared by all
+        # conductors
+        wspecs = ["{:.2f}".format(width).replace('.', 'p') for width in widths]
+        sspecs = ["{:.2f}".format(separation).replace('.', 'p') for separation in seps]
 
+        for conductor in conductors:
             # Generate the stack for this particular combination of
             # reference conductor and metal
             pstack = ordered_stack(conductor, [metal], layers)
@@ -172,14 +186,19 @@ def build_fc_files_w2(stackupfile, metallist, condlist, widths, seps, outfile, t
                     print(str(p))
                 print('')
 
-            for separation in seps:
-                sspec = "{:.2f}".format(separation).replace('.', 'p')
-                for width in widths:
-                    wspec = "{:.2f}".format(width).replace('.', 'p')
-                    filename = process + '/fastercap_files/w2/' + metal + '_' + conductor + '_w_' + wspec + '_s_' + sspec + '.lst'
+            # Part of the file name shared by every file for this pair
+            fileprefix = f'{filedir}/{metal}_{conductor}_w_'
+
+            for separation, sspec in zip(seps, sspecs):
+                for width, wspec in zip(widths, wspecs):
+                    filename = f'{fileprefix}{wspec}_s_{sspec}.lst'
                     spacing = separation + width
-                    generate_two_wire_file(filename, conductor, metal, width, spacing, pstack)
                     filelist.append(filename)
+                    fileparams.append((metal, conductor, width, separation))
+                    tasks.append((filename, conductor, metal, width, spacing, pstack))
+
+    # Write out all of the FasterCap input files
+    generate_files(generate_two_wire_file, tasks)
 
     #--------------------------------------------------------------
     # Simulate with fastercap
@@ -189,61 +208,18 @@ def build_fc_files_w2(stackupfile, metallist, condlist, widths, seps, outfile, t
         print('Tolerance set to zero;  skipping FasterCap run')
         return 0
 
-    fastercapexec = os.getenv('FASTERCAP_EXEC')
-    if not fastercapexec:
-        fastercapexec = 'FasterCap'
+    # Each FasterCap run is independent, so run them all at once
+    # (up to one per CPU), largest geometries (two wires and the
+    # space between them) first.
 
-    presults = []
+    sizelist = [2 * width + sep for metal, conductor, width, sep in fileparams]
+    gmatrices = run_fastercap_batch(filelist, tolerance, verbose, sizelist)
 
-    for file in filelist:
-        loctol = tolerance
-        print('Running FasterCap on input file ' + file)
-        done = False
-        while not done:
-            tolspec = "-a{:.3f}".format(loctol)
-            try:
-                proc = subprocess.run([fastercapexec, '-b', file, tolspec],
-			stdin = subprocess.DEVNULL,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,
-			universal_newlines = True,
-                	timeout = 30)
-            except subprocess.TimeoutExpired:
-                if loctol > 0.1:
-                    print('ERROR:  Failing with high tolerance;  bailing.')
-                    break
-                loctol *= 2
-                if verbose > 0:
-                    print('Trying again with tolerance = ' + '{:.3f}'.format(loctol))
-            else:
-                done = True
-                if loctol > 0.01:
-                    print('WARNING:  High tolerance value (' + tolspec + ') used.')
-
-        if proc.stdout:
-            if verbose > 1:
-                print('Diagnostic output from FasterCap:')
-            for line in proc.stdout.splitlines():
-                if verbose > 1:
-                    print(line)
-                if 'g1_' in line:
-                    g1line = line.split()
-                    g00 = float(g1line[1])
-                    g01 = float(g1line[2])
-                elif 'g2_' in line:
-                    g2line = line.split()
-                    g10 = float(g2line[1])
-                    g11 = float(g2line[2])
-
-        if proc.stderr:
-            print('Error message output from FasterCap:')
-            for line in proc.stderr.splitlines():
-                print(line)
-
-        if proc.returncode != 0:
-            print('ERROR:  FasterCap exited with status ' + str(proc.returncode))
-
-        if done:
+    presults = []
+    for (metal, conductor, width, sep), gmatrix in zip(fileparams, gmatrices):
+        if gmatrix:
+            g00, g01 = gmatrix[0][0:2]
+            g10, g11 = gmatrix[1][0:2]
             cdiag = (g00 + g11) / 2
             # ccoup = -(g01 + g10) / 2
             ccoup = -g10
@@ -254,13 +230,6 @@ def build_fc_files_w2(stackupfile, metallist, condlist, widths, seps, outfile, t
             print('Result:  Ccoup=' + scoup + '  Csub=' + ssub)
 
             # Add to results
-            fileroot = os.path.splitext(file)[0]
-            filename = os.path.split(fileroot)[-1]
-            values = filename.split('_')
-            metal = values[0]
-            conductor = values[1]
-            width = float(values[3].replace('p', '.'))
-            sep = float(values[5].replace('p', '.'))
             presults.append([metal, conductor, width, sep, csub, ccoup])
 
     #--------------------------------------------------------------
@@ -271,6 +240,19 @@ def build_fc_files_w2(stackupfile, metallist, condlist, widths, seps, outfile, t
         print('No results to save or print.')
         return 0
 
+    # Format all of the results once, for both the output file
+    # and the terminal.
+    lines = []
+    for presult in presults:
+        metal = presult[0]
+        conductor = presult[1]
+        swidth = "{:.4f}".format(presult[2])
+        ssep = "{:.4f}".format(presult[3])
+        ssub = "{:.5g}".format(presult[4])
+        scoup = "{:.5g}".format(presult[5])
+        lines.append(metal + ' ' + conductor + ' ' + swidth + ' ' + ssep + ' ' + ssub + ' ' + scoup + '\n')
+    results = ''.join(lines)
+
     if outfile:
         # Make sure the output directory exists
         outdir = os.path.split(outfile)[0]
@@ -278,25 +260,11 @@ def build_fc_files_w2(stackupfile, metallist, condlist, widths, seps, outfile, t
             os.makedirs(outdir, exist_ok=True)
 
         with open(outfile, 'w') as ofile:
-            for presult in presults:
-                metal = presult[0]
-                conductor = presult[1]
-                swidth = "{:.4f}".format(presult[2])
-                ssep = "{:.4f}".format(presult[3])
-                ssub = "{:.5g}".format(presult[4])
-                scoup = "{:.5g}".format(presult[5])
-                print(metal + ' ' + conductor + ' ' + swidth + ' ' + ssep + ' ' + ssub + ' ' + scoup, file=ofile)
+            ofile.write(results)
 
     # Also print results to the terminal
     print('Results:')
-    for presult in presults:
-        metal = presult[0]
-        conductor = presult[1]
-        swidth = "{:.4f}".format(presult[2])
-        ssep = "{:.4f}".format(presult[3])
-        ssub = "{:.5g}".format(presult[4])
-        scoup = "{:.5g}".format(presult[5])
-        print(metal + ' ' + conductor + ' ' + swidth + ' ' + ssep + ' ' + ssub + ' ' + scoup)
+    print(results, end='')
 
     return 0
 
@@ -417,12 +385,12 @@ if __name__ == '__main__':
     if use_default_width:
         widths = None
     else:
-        widths = list(numpy.arange(wstart, wstop, wstep))
+        widths = sweep_range(wstart, wstop, wstep)
 
     if use_default_sep:
         seps = None
     else:
-        seps = list(numpy.arange(sstart, sstop, sstep))
+        seps = sweep_range(sstart, sstop, sstep)
 
     rval = build_fc_files_w2(arguments[0], metallist, condlist, widths, seps, outfile, tolerance, verbose)
     sys.exit(rval)
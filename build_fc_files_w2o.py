@@ -13,28 +13,17 @@
 #
 import os
 import sys
-import numpy
-import subprocess
 
 # Local files
+from load_stack import load_stack
 from ordered_stack import ordered_stack
-from generate_geometry import generate_two_offset_wire_file
+from sweep_range import sweep_range
+from fc_args import base_parser, comma_list, sweep_spec
+from generate_geometry import generate_two_offset_wire_file, generate_files
+from run_fastercap import run_fastercap_batch, fastercap_dir
 
-#--------------------------------------------------------------
-# Usage statement
-#--------------------------------------------------------------
-
-def usage():
-    print('Usage:  build_fc_files_w2o.py <stack_def_file> [options]')
-    print('  Where [options] may be one or more of:')
-    print('     -metal1=<metal>[,...] (restrict 1st wire type to one or more metals)')
-    print('     -metal2=<metal>[,...] (restrict 2nd wire type to one or more metals)')
-    print('     -sub[strate]=<substrate>      (substrate type)')
-    print('     -width1=<start>,<stop>,<step> (1st wire width range, in microns)')
-    print('     -width2=<start>,<stop>,<step> (2nd wire width range, in microns)')
-    print('     -sep=<start>,<stop>,<step>    (separation range, in microns)')
-    print('     -tol[erance]=<value>          (FasterCap tolerance)')
-    print('     -file=<name>                  (output filename for results)')
+# Translation table for turning a value like -1.50 into "n1p50" in filenames
+spec_trans = str.maketrans({'.': 'p', '-': 'n'})
 
 #--------------------------------------------------------------
 # The main routine
@@ -57,36 +46,35 @@ def usage():
 
 def build_fc_files_w2o(stackupfile, metal1list, metal2list, widths1, widths2, seps, outfile, tolerance, verbose=0):
 
-    use_default_width1 = True if not widths1 else False
-    use_default_width2 = True if not widths2 else False
-    use_default_sep = True if not seps else False
+    use_default_width1 = True if widths1 is None or len(widths1) == 0 else False
+    use_default_width2 = True if widths2 is None or len(widths2) == 0 else False
+    use_default_sep = True if seps is None or len(seps) == 0 else False
 
     #--------------------------------------------------------------
     # Obtain the metal stack.  The metal stack file is in the
-    # format of executable python, so use exec().
+    # format of executable python (see load_stack.py).
     #--------------------------------------------------------------
 
     try:
-        locals = {}
-        exec(open(stackupfile, 'r').read(), None, locals)
+        stackvars = load_stack(stackupfile)
     except:
         print('Error:  No metal stack file ' + stackupfile + '!')
         return 1
 
     try:
-        process = locals['process']
+        process = stackvars['process']
     except:
         print('Warning:  Metal stack does not define process!')
         process = 'unknown'
 
     try:
-        layers = locals['layers']
+        layers = stackvars['layers']
     except:
         print('Error:  Metal stack does not define layers!')
         return 1
 
     try:
-        limits = locals['limits']
+        limits = stackvars['limits']
     except:
         print('Error:  Metal stack does not define limits!')
         return 1
@@ -96,30 +84,33 @@ def build_fc_files_w2o(stackupfile, metal1list, metal2list, widths1, widths2, se
     #--------------------------------------------------------------
 
     # "metals" is a reorganization of the full stack list to include
-    # just the metal layers and their heights and thicknesses.
+    # just the metal layers and their heights and thicknesses, and
+    # "substrates" the ground plane (diffusion) layers.  Both are
+    # picked out in one pass over the stack.
 
     metals = []
+    substrates = []
     for lname, layer in layers.items():
         if layer[0] == 'm':
             metals.append(lname)
+        elif layer[0] == 'd':
+            substrates.append(lname)
 
-    substrate = None
-    for lname, layer in layers.items():
-        if layer[0] == 'd':
-            substrate = lname
-            break
+    substrate = substrates[0] if substrates else None
 
     # Check options
 
-    for metal1 in metal1list.copy():
-        if metal1 not in metals:
+    metalset = set(metals)
+
+    for metal1 in metal1list:
+        if metal1 not in metalset:
             print('Error:  1st wire metal "' + metal1 + '" is not in the stackup!')
-            metal1list.remove(metal1)
+    metal1list = [metal1 for metal1 in metal1list if metal1 in metalset]
 
-    for metal2 in metal2list.copy():
-        if metal2 not in metals:
+    for metal2 in metal2list:
+        if metal2 not in metalset:
             print('Error:  2nd wire metal "' + metal2 + '" is not in the stackup!')
-            metal2list.remove(metal2)
+    metal2list = [metal2 for metal2 in metal2list if metal2 in metalset]
 
     # Set default values if not specified in options
 
@@ -134,14 +125,34 @@ def build_fc_files_w2o(stackupfile, metal1list, metal2list, widths1, widths2, se
     if verbose > 0:
         print('Simulation parameters:')
         print('   1st wire widths = ' + str(widths1))
-        print('   2nd wire widths = ' + str(widths1))
+        print('   2nd wire widths = ' + str(widths2))
         print('   Wire separations = ' + str(seps))
         print('')
 
+    # Each FasterCap input file and the (metal1, metal2, width1,
+    # width2, separation) parameters it was generated from.
     filelist = []
+    fileparams = []
+    tasks = []
 
     # Make sure the working directory exists
-    os.makedirs(process + '/fastercap_files/w2o', exist_ok=True)
+    filedir = fastercap_dir(process, 'w2o')
+    os.makedirs(filedir, exist_ok=True)
+
+    # The 2nd wire widths and their filename tags depend only on
+    # metal2, so work them out once for each metal2 rather than
+    # again for every metal1.
+    w2sweeps = {}
+    for metal2 in metal2list:
+        if use_default_width2 == True:
+            min2width = limits[metal2][0]
+            w2start = min2width
+            w2stop = 10 * min2width + 0.5 * min2width
+            w2step = 9 * min2width
+            widths2 = sweep_range(w2start, w2stop, w2step)
+
+        w2specs = [f'{width2:.2f}'.translate(spec_trans) for width2 in widths2]
+        w2sweeps[metal2] = (widths2, w2specs)
 
     for metal1 in metal1list:
         if use_default_width1 == True:
@@ -149,22 +160,28 @@ def build_fc_files_w2o(stackupfile, metal1list, metal2list, widths1, widths2, se
             w1start = min1width
             w1stop = 10 * min1width + 0.5 * min1width
             w1step = 9 * min1width
-            widths1 = list(numpy.arange(w1start, w1stop, w1step))
+            widths1 = sweep_range(w1start, w1stop, w1step)
 
         if use_default_sep == True:
             minsep = limits[metal1][1]
             sstart = -10 * minsep
             sstop = 10 * minsep + 0.5 * minsep
             sstep = minsep
-            seps = list(numpy.arange(sstart, sstop, sstep))
+            seps = sweep_range(sstart, sstop, sstep)
 
+        # Filename tags for each 1st wire width and separation, shared
+        # by all 2nd wire metals
+        w1specs = [f'{width1:.2f}'.translate(spec_trans) for width1 in widths1]
+        sspecs = [f'{separation:.2f}'.translate(spec_trans) for separation in seps]
+
+        # Two wires on the same metal layer would overlap at small
+        # or negative separations;  that case is covered by _w2.
+        # Skip it before building the stack.
         for metal2 in metal2list:
-            if use_default_width2 == True:
-                min2width = limits[metal2][0]
-                w2start = min2width
-                w2stop = 10 * min2width + 0.5 * min2width
-                w2step = 9 * min2width
-                widths2 = list(numpy.arange(w2start, w2stop, w2step))
+            if metal2 == metal1:
+                continue
+
+            widths2, w2specs = w2sweeps[metal2]
 
             # Generate the stack for this particular combination of
             # reference conductor and metal
@@ -177,15 +194,16 @@ def build_fc_files_w2o(stackupfile, metal1list, metal2list, widths1, widths2, se
                     print(str(p))
                 print('')
 
-            for separation in seps:
-                sspec = "{:.2f}".format(separation).replace('.', 'p').replace('-', 'n')
-                for width1 in widths1:
-                    w1spec = "{:.2f}".format(width1).replace('.', 'p').replace('-', 'n')
-                    for width2 in widths2:
-                        w2spec = "{:.2f}".format(width2).replace('.', 'p').replace('-', 'n')
-                        filename = process + '/fastercap_files/w2o/' + metal1 + '_w_' + w1spec + '_' + metal2 + '_w_' + w2spec + '_s_' + sspec + '.lst'
-                        generate_two_offset_wire_file(filename, substrate, metal1, width1, metal2, width2, separation, pstack)
+            for separation, sspec in zip(seps, sspecs):
+                for width1, w1spec in zip(widths1, w1specs):
+                    for width2, w2spec in zip(widths2, w2specs):
+                        filename = f'{filedir}/{metal1}_w_{w1spec}_{metal2}_w_{w2spec}_s_{sspec}.lst'
                         filelist.append(filename)
+                        fileparams.append((metal1, metal2, width1, width2, separation))
+                        tasks.append((filename, substrate, metal1, width1, metal2, width2, separation, pstack))
+
+    # Write out all of the FasterCap input files
+    generate_files(generate_two_offset_wire_file, tasks)
 
     #--------------------------------------------------------------
     # Simulate with fastercap
@@ -195,61 +213,29 @@ def build_fc_files_w2o(stackupfile, metal1list, metal2list, widths1, widths2, se
         print('Tolerance set to zero;  skipping FasterCap run')
         return 0
 
-    fastercapexec = os.getenv('FASTERCAP_EXEC')
-    if not fastercapexec:
-        fastercapexec = 'FasterCap'
-
-    presults = []
-
-    for file in filelist:
-        loctol = tolerance
-        print('Running FasterCap on input file ' + file)
-        done = False
-        while not done:
-            tolspec = "-a{:.3f}".format(loctol)
-            try:
-                proc = subprocess.run([fastercapexec, '-b', file, tolspec],
-			stdin = subprocess.DEVNULL,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,
-			universal_newlines = True,
-                	timeout = 30)
-            except subprocess.TimeoutExpired:
-                if loctol > 0.1:
-                    print('ERROR:  Failing with high tolerance;  bailing.')
-                    break
-                loctol *= 2
-                if verbose > 0:
-                    print('Trying again with tolerance = ' + '{:.3f}'.format(loctol))
-            else:
-                done = True
-                if loctol > 0.01:
-                    print('WARNING:  High tolerance value (' + tolspec + ') used.')
-
-        if proc.stdout:
-            if verbose > 1:
-                print('Diagnostic output from FasterCap:')
-            for line in proc.stdout.splitlines():
-                if verbose > 1:
-                    print(line)
-                if 'g1_' in line:
-                    g1line = line.split()
-                    g00 = float(g1line[1])
-                    g01 = float(g1line[2])
-                elif 'g2_' in line:
-                    g2line = line.split()
-                    g10 = float(g2line[1])
-                    g11 = float(g2line[2])
-
-        if proc.stderr:
-            print('Error message output from FasterCap:')
-            for line in proc.stderr.splitlines():
-                print(line)
-
-        if proc.returncode != 0:
-            print('ERROR:  FasterCap exited with status ' + str(proc.returncode))
-
-        if done:
+    # Results are written to "<outfile>.part" as they come in, so
+    # that the results so far are kept if the run is interrupted.
+    # When the run is complete, the results are written again in
+    # sweep order, and the file is renamed to "outfile" (note that
+    # compute_coefficients.py takes an existing "outfile" to mean
+    # that the run was already done).
+
+    if outfile:
+        # Make sure the output directory exists
+        outdir = os.path.split(outfile)[0]
+        if outdir != '':
+            os.makedirs(outdir, exist_ok=True)
+        ofile = open(outfile + '.part', 'w')
+    else:
+        ofile = None
+
+    presults = {}
+
+    def save_result(i, gmatrix):
+        if gmatrix:
+            metal1, metal2, width1, width2, sep = fileparams[i]
+            g00, g01 = gmatrix[0][0:2]
+            g10, g11 = gmatrix[1][0:2]
             m1sub = g00 + g01
             m2sub = g10 + g11
             # ccoup = -(g01 + g10) / 2
@@ -261,15 +247,24 @@ def build_fc_files_w2o(stackupfile, metal1list, metal2list, widths1, widths2, se
             print('Result:  Ccoup=' + scoup + '  Cm1sub=' + sm1sub + '  Cm2sub=' + sm2sub)
 
             # Add to results
-            fileroot = os.path.splitext(file)[0]
-            filename = os.path.split(fileroot)[-1]
-            values = filename.split('_')
-            metal1 = values[0]
-            width1 = float(values[2].replace('p', '.').replace('n', '-'))
-            metal2 = values[3]
-            width2 = float(values[5].replace('p', '.').replace('n', '-'))
-            sep = float(values[7].replace('p', '.').replace('n', '-'))
-            presults.append([metal1, metal2, width1, width2, sep, m1sub, m2sub, ccoup])
+            s1width = "{:.4f}".format(width1)
+            s2width = "{:.4f}".format(width2)
+            ssep = "{:.4f}".format(sep)
+            presult = metal1 + ' ' + metal2 + ' ' + s1width + ' ' + s2width + ' ' + ssep + ' ' + sm1sub + ' ' + sm2sub + ' ' + scoup
+            presults[i] = presult
+            if ofile:
+                print(presult, file=ofile, flush=True)
+
+    # Each FasterCap run is independent, so run them all at once
+    # (up to one per CPU), largest geometries (both wires and the
+    # offset between them) first.
+
+    sizelist = [width1 + width2 + abs(sep) for metal1, metal2, width1, width2, sep in fileparams]
+    try:
+        run_fastercap_batch(filelist, tolerance, verbose, sizelist, callback=save_result)
+    finally:
+        if ofile:
+            ofile.close()
 
     #--------------------------------------------------------------
     # Save (and print) results
@@ -277,38 +272,20 @@ def build_fc_files_w2o(stackupfile, metal1list, metal2list, widths1, widths2, se
 
     if len(presults) == 0:
         print('No results to save or print.')
+        if ofile:
+            os.remove(outfile + '.part')
         return 0
 
-    if outfile:
-        # Make sure the output directory exists
-        outdir = os.path.split(outfile)[0]
-        if outdir != '':
-            os.makedirs(outdir, exist_ok=True)
+    results = ''.join(presults[i] + '\n' for i in sorted(presults))
 
-        with open(outfile, 'w') as ofile:
-            for presult in presults:
-                metal1 = presult[0]
-                metal2 = presult[1]
-                s1width = "{:.4f}".format(presult[2])
-                s2width = "{:.4f}".format(presult[3])
-                ssep = "{:.4f}".format(presult[4])
-                sm1sub = "{:.5g}".format(presult[5])
-                sm2sub = "{:.5g}".format(presult[6])
-                scoup = "{:.5g}".format(presult[7])
-                print(metal1 + ' ' + metal2 + ' ' + s1width + ' ' + s2width + ' ' + ssep + ' ' + sm1sub + ' ' + sm2sub + ' ' + scoup, file=ofile)
+    if ofile:
+        with open(outfile + '.part', 'w') as ofile:
+            ofile.write(results)
+        os.replace(outfile + '.part', outfile)
 
     # Also print results to the terminal
     print('Results:')
-    for presult in presults:
-        metal1 = presult[0]
-        metal2 = presult[1]
-        s1width = "{:.4f}".format(presult[2])
-        s2width = "{:.4f}".format(presult[3])
-        ssep = "{:.4f}".format(presult[4])
-        sm1sub = "{:.5g}".format(presult[5])
-        sm2sub = "{:.5g}".format(presult[6])
-        scoup = "{:.5g}".format(presult[7])
-        print(metal1 + ' ' + metal2 + ' ' + s1width + ' ' + s2width + ' ' + ssep + ' ' + sm1sub + ' ' + sm2sub + ' ' + scoup)
+    print(results, end='')
 
     return 0
 
@@ -318,161 +295,38 @@ def build_fc_files_w2o(stackupfile, metal1list, metal2list, widths1, widths2, se
 
 if __name__ == '__main__':
 
-    options = []
-    arguments = []
-    for item in sys.argv[1:]:
-        if item.find('-', 0) == 0:
-            options.append(item)
-        else:
-            arguments.append(item)
-
-    if len(arguments) != 1:
-        print('Argument length is ' + str(len(arguments)))
-        usage()
-        sys.exit(1)
-
-    metal1list = []
-    metal2list = []
-    use_default_width1 = True
-    w1start = 0
-    w1stop = 0
-    w1step = 0
-    use_default_width2 = True
-    w2start = 0
-    w2stop = 0
-    w2step = 0
-    use_default_sep = True
-    sstart = 0
-    sstop = 0
-    sstep = 0
-    substrate = None
-    outfile = None
-    verbose = 0
-    tolerance = 0.01
-
-    for option in options:
-        tokens = option.split('=')
-        if len(tokens) != 2:
-            print('Error:  Option "' + option + '":  Option must be in form "-key=<value>".')
-            usage()
-            continue
-        if tokens[0] == '-file':
-            outfile = tokens[1]
-        elif tokens[0] == '-verbose':
-            try:
-                verbose = int(tokens[1])
-            except:
-                print('Error:  Verbose level "' + tokens[1] + '" is not numeric.')
-                continue
-        elif tokens[0] == '-tol' or tokens[0] == '-tolerance':
-            try:
-                tolerance = float(tokens[1])
-            except:
-                print('Error:  Tolerance "' + tokens[1] + '" is not numeric.')
-                continue
-        elif tokens[0] == '-metal1':
-            metal1list = tokens[1].split(',')
-        elif tokens[0] == '-metal2':
-            metal2list = tokens[1].split(',')
-        elif tokens[0] == '-sub' or tokens[0] == '-substrate':
-            subname = tokens[1]
-        elif tokens[0] == '-width1':
-            rangelist = tokens[1].split(',')
-            if len(rangelist) != 3:
-                print('Error:  1st wire width needs three comma-separated values')
-                usage()
-                continue
-            optstr = rangelist[0].replace('um','')
-            try:
-                w1start = float(optstr)
-            except:
-                print('Error:  1st wire width start value "' + optstr + '" is not numeric.')
-                continue
-            optstr = rangelist[1].replace('um','')
-            try:
-                w1stop = float(optstr)
-            except:
-                print('Error:  1st wire width end value "' + optstr + '" is not numeric.')
-                continue
-            optstr = rangelist[2].replace('um','')
-            try:
-                w1step = float(optstr)
-            except:
-                print('Error:  1st wire width step value "' + optstr + '" is not numeric.')
-                continue
-            use_default_width1 = False
-        elif tokens[0] == '-width2':
-            rangelist = tokens[1].split(',')
-            if len(rangelist) != 3:
-                print('Error:  2nd wire width needs three comma-separated values')
-                usage()
-                continue
-            optstr = rangelist[0].replace('um','')
-            try:
-                w2start = float(optstr)
-            except:
-                print('Error:  2nd wire width start value "' + optstr + '" is not numeric.')
-                continue
-            optstr = rangelist[1].replace('um','')
-            try:
-                w2stop = float(optstr)
-            except:
-                print('Error:  2nd wire width end value "' + optstr + '" is not numeric.')
-                continue
-            optstr = rangelist[2].replace('um','')
-            try:
-                w2step = float(optstr)
-            except:
-                print('Error:  2nd wire width step value "' + optstr + '" is not numeric.')
-                continue
-            use_default_width2 = False
-        elif tokens[0] == '-sep':
-            rangelist = tokens[1].split(',')
-            if len(rangelist) != 3:
-                print('Error:  Separation needs three comma-separated values')
-                usage()
-                continue
-            optstr = rangelist[0].replace('um','')
-            try:
-                sstart = float(optstr)
-            except:
-                print('Error:  Separation start value "' + optstr + '" is not numeric.')
-                continue
-            optstr = rangelist[1].replace('um','')
-            try:
-                sstop = float(optstr)
-            except:
-                print('Error:  Separation end value "' + optstr + '" is not numeric.')
-                continue
-            optstr = rangelist[2].replace('um','')
-            try:
-               sstep = float(optstr)
-            except:
-                print('Error:  Separation step value "' + optstr + '" is not numeric.')
-                continue
-            use_default_sep = False
-        else:
-            print('Error:  Unknown option "' + option + '"')
-            usage()
-            continue
+    parser = base_parser('build_fc_files_w2o.py')
+    parser.add_argument('-metal1', metavar='<metal>[,...]', dest='metal1list', type=comma_list, default=[],
+		help='restrict 1st wire type to one or more metals')
+    parser.add_argument('-metal2', metavar='<metal>[,...]', dest='metal2list', type=comma_list, default=[],
+		help='restrict 2nd wire type to one or more metals')
+    parser.add_argument('-sub', '-substrate', metavar='<substrate>', dest='substrate',
+		help='substrate type')
+    parser.add_argument('-width1', metavar='<start>,<stop>,<step>', type=sweep_spec,
+		help='1st wire width range, in microns')
+    parser.add_argument('-width2', metavar='<start>,<stop>,<step>', type=sweep_spec,
+		help='2nd wire width range, in microns')
+    parser.add_argument('-sep', metavar='<start>,<stop>,<step>', type=sweep_spec,
+		help='separation range, in microns')
+    args = parser.parse_args()
 
     # Call the main routine
 
-    if use_default_width1:
-        widths1 = None
+    if args.width1:
+        widths1 = sweep_range(*args.width1)
     else:
-        widths1 = list(numpy.arange(w1start, w1stop, w1step))
+        widths1 = None
 
-    if use_default_width2:
-        widths2 = None
+    if args.width2:
+        widths2 = sweep_range(*args.width2)
     else:
-        widths2 = list(numpy.arange(w2start, w2stop, w2step))
+        widths2 = None
 
-    if use_default_sep:
-        seps = None
+    if args.sep:
+        seps = sweep_range(*args.sep)
     else:
-        seps = list(numpy.arange(sstart, sstop, sstep))
+        seps = None
 
-    rval = build_fc_files_w2(arguments[0], metal1list, metal2list, widths1, widths2, seps, outfile, tolerance, verbose)
+    rval = build_fc_files_w2o(args.stackupfile, args.metal1list, args.metal2list, widths1, widths2,
+		seps, args.outfile, args.tolerance, args.verbose)
     sys.exit(rval)
-
@@ -13,9 +13,19 @@
 # December 27, 2022
 #
 import os
+import re
 import sys
 import numpy
+import tempfile
+import functools
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Local files
+from load_stack import load_stack
+
+# Translation table for turning a width like 1.50 into "1p50" in filenames
+wspec_trans = str.maketrans('.', 'p')
 
 #---------------------------------------------------
 # Usage statement
@@ -29,6 +39,92 @@ def usage():
     print('     -width=<start>,<stop>,<step> (wire width range, in microns)')
     print('     -file=<name>                 (output filename for results)')
 
+#--------------------------------------------------------------
+# Regular expression matching a capacitor between nodes A and B
+# in the extracted SPICE netlist, and capturing its value (e.g.,
+# "C0 A B 12.3f").
+#--------------------------------------------------------------
+
+capline_re = re.compile(r'^C\S*[ \t]+(?:A[ \t]+B|B[ \t]+A)[ \t]+(\S+)', re.MULTILINE)
+
+#--------------------------------------------------------------
+# The magic Tcl script for one geometry:  a wire of width
+# "wspec" on magic layer "mmetal" (labeled A) over a plane of
+# magic layer "mcond" (labeled B), extracted to SPICE.
+# "extractstyle" is either empty or an "extract style" command
+# line.
+#--------------------------------------------------------------
+
+w1_script = '''load test -silent
+box values 0 0 {wspec}um 1000um
+paint {mmetal}
+label A c {mmetal}
+box values -40um -40um 40um 1040um
+paint {mcond}
+box values -20um -20um -20um -20um
+label B c {mcond}
+{extractstyle}catch {{extract halo 50um}}
+extract all
+ext2spice lvs
+ext2spice cthresh 0
+ext2spice
+quit -noprompt
+'''
+
+#--------------------------------------------------------------
+# Run magic on the Tcl script "file" in directory "filedir" and
+# return the capacitance extracted between the wire (A) and the
+# conductor (B), or None if magic timed out.  Magic always writes
+# its output to "test.ext" and "test.spice" in the directory it
+# is run in, so each run is made in its own temporary directory
+# (which is removed afterward), and several runs can be made at
+# the same time.
+#--------------------------------------------------------------
+
+def run_magic(magicexec, startupscript, filedir, file, verbose=0):
+    print('Running Magic on input file ' + file)
+    with tempfile.TemporaryDirectory(dir=filedir) as rundir:
+        try:
+            print('Running  magic -dnull -noconsole -rcfile ' + startupscript + ' ' + file)
+            proc = subprocess.run([magicexec, '-dnull', '-noconsole', '-rcfile',
+			os.path.abspath(startupscript), os.path.abspath(filedir + '/' + file)],
+			stdin = subprocess.DEVNULL,
+			stdout = subprocess.PIPE,
+			stderr = subprocess.PIPE,
+			universal_newlines = True,
+			cwd = rundir,
+			timeout = 30)
+        except subprocess.TimeoutExpired:
+            return None
+
+        if proc.stdout:
+            if verbose > 1:
+                print('Diagnostic output from Magic:')
+            for line in proc.stdout.splitlines():
+                if verbose > 1:
+                    print(line)
+
+        if proc.stderr:
+            print('Error message output from Magic:')
+            for line in proc.stderr.splitlines():
+                print(line)
+
+        if proc.returncode != 0:
+            print('ERROR:  Magic exited with status ' + str(proc.returncode))
+
+        # Read output SPICE file
+        csub = 0.0
+        with open(rundir + '/test.spice', 'r') as ifile:
+            cvalues = capline_re.findall(ifile.read())
+        if cvalues:
+            cvalue = cvalues[-1].lower()
+            if 'p' in cvalue:
+                csub = 1e-9 * float(cvalue.replace('p', '').replace('f', ''))
+            else:
+                csub = 1e-9 * float(cvalue.replace('f', '')) / 1000
+
+    return csub
+
 #--------------------------------------------------------------
 # The main routine
 #
@@ -52,42 +148,41 @@ def build_mag_files_w1(stackupfile, startupscript, metallist, condlist, widths,
 
     #--------------------------------------------------------------
     # Obtain the metal stack.  The metal stack file is in the
-    # format of executable python, so use exec().
+    # format of executable python (see load_stack.py).
     #--------------------------------------------------------------
 
     try:
-        locals = {}
-        exec(open(stackupfile, 'r').read(), None, locals)
+        stackvars = load_stack(stackupfile)
     except:
         print('Error:  No metal stack file ' + stackupfile + '!')
         return 1
 
     try:
-        process = locals['process']
+        process = stackvars['process']
     except:
         print('Warning:  Metal stack does not define process!')
         process = 'unknown'
 
     try:
-        layers = locals['layers']
+        layers = stackvars['layers']
     except:
         print('Error:  Metal stack does not define layers!')
         return 1
 
     try:
-        limits = locals['limits']
+        limits = stackvars['limits']
     except:
         print('Error:  Metal stack does not define limits!')
         return 1
 
     try:
-        magiclayers = locals['magiclayers']
+        magiclayers = stackvars['magiclayers']
     except:
         print('Error:  Metal stack does not define magiclayers!')
         return 1
 
     try:
-        magicextractstyle = locals['magicextractstyle']
+        magicextractstyle = stackvars['magicextractstyle']
     except:
         # Use default
         magicextractstyle = None
@@ -150,6 +245,11 @@ def build_mag_files_w1(stackupfile, startupscript, metallist, condlist, widths,
     # Make sure the output directory exists
     os.makedirs(process + '/magic_files/w1', exist_ok=True)
 
+    if magicextractstyle:
+        extractstyle = 'extract style ' + magicextractstyle + '\n'
+    else:
+        extractstyle = ''
+
     for metal in metallist:
         mmetal = magiclayers[metal]
 
@@ -179,26 +279,12 @@ def build_mag_files_w1(stackupfile, startupscript, metallist, condlist, widths,
             mcond = magiclayers[conductor]
             for width in widths:
                 wspec = "{:.2f}".format(width)
-                wsspec = "{:.2f}".format(width).replace('.', 'p')
+                wsspec = wspec.translate(wspec_trans)
                 filename = metal + '_' + conductor + '_w_' + wsspec + '.tcl'
                 with open(process + '/magic_files/w1/' + filename, 'w') as ofile:
-                    print('load test -silent', file=ofile)
-                    print('box values 0 0 ' + wspec + 'um 1000um', file=ofile)
-                    print('paint ' + mmetal, file=ofile)
-                    print('label A c ' + mmetal, file=ofile)
-                    print('box values -40um -40um 40um 1040um', file=ofile)
-                    print('paint ' + mcond, file=ofile)
-                    print('box values -20um -20um -20um -20um', file=ofile)
-                    print('label B c ' + mcond, file=ofile)
-                    if magicextractstyle:
-                        print('extract style ' + magicextractstyle, file=ofile)
-                    print('catch {extract halo 50um}', file=ofile)
-                    print('extract all', file=ofile)
-                    print('ext2spice lvs', file=ofile)
-                    print('ext2spice cthresh 0', file=ofile)
-                    print('ext2spice', file=ofile)
-                    print('quit -noprompt', file=ofile)
-  
+                    ofile.write(w1_script.format(wspec=wspec, mmetal=mmetal, mcond=mcond,
+				extractstyle=extractstyle))
+
                 filelist.append(filename)
 
     #--------------------------------------------------------------
@@ -213,69 +299,54 @@ def build_mag_files_w1(stackupfile, startupscript, metallist, condlist, widths,
     if not magicexec:
         magicexec = 'magic'
 
-    presults = []
+    # Results are written to "<outfile>.part" as they come in, so
+    # that the results so far are kept if the run is interrupted.
+    # When the run is complete, the results are written again in
+    # sweep order, and the file is renamed to "outfile".
 
-    for file in filelist:
-        print('Running Magic on input file ' + file)
-        try:
-            print('Running  magic -dnull -noconsole -rcfile ' + startupscript + ' ' + file)
-            proc = subprocess.run(['magic', '-dnull', '-noconsole', '-rcfile', startupscript, file],
-			stdin = subprocess.DEVNULL,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,
-			universal_newlines = True,
-			cwd = process + '/magic_files/w1',
-			timeout = 30)
-        except subprocess.TimeoutExpired:
-            # Just ignore this result
-            pass
-        else:
+    if outfile:
+        # Make sure the output directory exists
+        outdir = os.path.split(outfile)[0]
+        if outdir != '':
+            os.makedirs(outdir, exist_ok=True)
+        ofile = open(outfile + '.part', 'w')
+    else:
+        ofile = None
 
-            if proc.stdout:
-                if verbose > 1:
-                    print('Diagnostic output from Magic:')
-                for line in proc.stdout.splitlines():
-                    if verbose > 1:
-                        print(line)
-
-            if proc.stderr:
-                print('Error message output from Magic:')
-                for line in proc.stderr.splitlines():
-                    print(line)
+    presults = {}
 
-            if proc.returncode != 0:
-                print('ERROR:  Magic exited with status ' + str(proc.returncode))
-
-            # Remove the .ext file
-            os.remove(process + '/magic_files/w1/test.ext')
-            # Read output SPICE file
-            csub = 0.0
-            with open(process + '/magic_files/w1/test.spice', 'r') as ifile:
-                spicelines = ifile.read().splitlines()
-                for line in spicelines:
-                    if line.startswith('C'):
-                        if 'A B' in line or 'B A' in line:
-                            tokens = line.split()
-                            if 'p' in tokens[3]:
-                                csub = 1e-9 * float(tokens[3].lower().replace('p', '').replace('f', ''))
-                            else:
-                                csub = 1e-9 * float(tokens[3].lower().replace('f', '')) / 1000
-                    
-
-            # Remove the SPICE file
-            os.remove(process + '/magic_files/w1/test.spice')
-
-            scsub = "{:.5g}".format(csub)
-            print('Result:  Csub=' + scsub)
-
-            # Add to results
-            fileroot = os.path.splitext(file)[0]
-            filename = os.path.split(fileroot)[-1]
-            values = filename.split('_')
-            metal = values[0]
-            conductor = values[1]
-            width = float(values[3].replace('p', '.'))
-            presults.append([metal, conductor, width, csub])
+    # Each run of magic is a separate process, so run them all at
+    # once (up to one per CPU), each in its own working directory,
+    # and handle each result as soon as its run finishes.
+    magicdir = process + '/magic_files/w1'
+    runmagic = functools.partial(run_magic, magicexec, startupscript, magicdir, verbose=verbose)
+    try:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {executor.submit(runmagic, file): i for i, file in enumerate(filelist)}
+            for future in as_completed(futures):
+                csub = future.result()
+                if csub is None:
+                    # Just ignore this result
+                    continue
+
+                scsub = "{:.5g}".format(csub)
+                print('Result:  Csub=' + scsub)
+
+                # Add to results
+                i = futures[future]
+                fileroot = os.path.splitext(filelist[i])[0]
+                filename = os.path.split(fileroot)[-1]
+                values = filename.split('_')
+                metal = values[0]
+                conductor = values[1]
+                swidth = "{:.4f}".format(float(values[3].replace('p', '.')))
+                presult = metal + ' ' + conductor + ' ' + swidth + ' ' + scsub
+                presults[i] = presult
+                if ofile:
+                    print(presult, file=ofile, flush=True)
+    finally:
+        if ofile:
+            ofile.close()
 
     #--------------------------------------------------------------
     # Save (and print) results
@@ -283,28 +354,20 @@ def build_mag_files_w1(stackupfile, startupscript, metallist, condlist, widths,
 
     if len(presults) == 0:
         print('No results to save or print.')
+        if ofile:
+            os.remove(outfile + '.part')
         return 0
 
-    if outfile:
-        # Make sure the output directory exists
-        os.makedirs(os.path.split(outfile)[0], exist_ok=True)
+    results = ''.join(presults[i] + '\n' for i in sorted(presults))
 
-        with open(outfile, 'w') as ofile:
-            for presult in presults:
-                metal = presult[0]
-                conductor = presult[1]
-                swidth = "{:.4f}".format(presult[2])
-                ssub = "{:.5g}".format(presult[3])
-                print(metal + ' ' + conductor + ' ' + swidth + ' ' + ssub, file=ofile)
+    if ofile:
+        with open(outfile + '.part', 'w') as ofile:
+            ofile.write(results)
+        os.replace(outfile + '.part', outfile)
 
     # Also print results to the terminal
     print('Results:')
-    for presult in presults:
-        metal = presult[0]
-        conductor = presult[1]
-        swidth = "{:.4f}".format(presult[2])
-        ssub = "{:.5g}".format(presult[3])
-        print(metal + ' ' + conductor + ' ' + swidth + ' ' + ssub)
+    print(results, end='')
 
     return 0
 
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+#
+# fc_args.py --
+#
+#	Command-line option parsing shared by the build_fc_files
+#	scripts.  Options keep the "-key=<value>" form used
+#	throughout capiche, e.g.:
+#
+#	    build_fc_files_w1.py <stack_def_file> -metals=m1,m2 -tol=0.005
+#
+import argparse
+
+#--------------------------------------------------------------
+# Option value types
+#--------------------------------------------------------------
+
+def comma_list(value):
+    return value.split(',')
+
+def sweep_spec(value):
+    rangelist = value.split(',')
+    if len(rangelist) != 3:
+        raise argparse.ArgumentTypeError('needs three comma-separated values <start>,<stop>,<step>')
+    try:
+        return [float(item.replace('um', '')) for item in rangelist]
+    except ValueError:
+        raise argparse.ArgumentTypeError('value "' + value + '" is not numeric')
+
+#--------------------------------------------------------------
+# Return an argument parser with the options common to all of
+# the build_fc_files scripts:  the stack file, tolerance,
+# results file, and verbose level.  "outfile" is the default
+# name of the results file.  Scripts may add their own options
+# to the parser before calling parse_args().
+#--------------------------------------------------------------
+
+def base_parser(prog, outfile=None):
+    parser = argparse.ArgumentParser(prog=prog, allow_abbrev=False)
+    parser.add_argument('stackupfile', metavar='stack_def_file',
+		help='metal stack definition file')
+    parser.add_argument('-tol', '-tolerance', metavar='<value>', dest='tolerance',
+		type=float, default=0.01, help='FasterCap tolerance')
+    parser.add_argument('-file', metavar='<name>', dest='outfile', default=outfile,
+		help='output filename for results')
+    parser.add_argument('-verbose', metavar='<value>', type=int, default=0,
+		help='diagnostic output level')
+    return parser
+
+#--------------------------------------------------------------
+# Return an argument parser for the scripts that sweep the
+# width of wires on a list of metals (the common options plus
+# "-metals" and "-width").
+#--------------------------------------------------------------
+
+def build_parser(prog, outfile=None):
+    parser = base_parser(prog, outfile)
+    parser.add_argument('-metals', metavar='<metal>[,...]', type=comma_list, default=[],
+		help='restrict wire type to one or more metals')
+    parser.add_argument('-width', metavar='<start>,<stop>,<step>', type=sweep_spec,
+		help='wire width range, in microns')
+    return parser
@@ -11,6 +11,7 @@
 # generate_one_shielded_wire_file(filename, substrate, conductor, metal, width, spacing, pstack)*
 # generate_two_wire_file(filename, conductor, metal, width, spacing, pstack)
 # generate_two_offset_wire_file(filename, substrate, conductor, cwidth, metal, mwidth, spacing, pstack)
+# generate_files(generator, tasks)
 #
 # *The routine generate_two_offset_wire_file() is essentially a more general form of
 # generate_one_shielded_wire_file().
@@ -18,6 +19,10 @@
 # To do: Make general case of generate_two_wire_file() that allows the width of each
 # wire to be specified independently.
 
+import io
+import functools
+from concurrent.futures import ProcessPoolExecutor
+
 # --------------------------------------------------------
 # generate_one_wire_file --
 #
@@ -58,7 +63,7 @@ def generate_one_wire_file(filename, conductor, metal, width, pstack):
 
     swidth = "{:.2f}".format(width)
 
-    with open(filename, 'w') as ofile:
+    with io.StringIO() as ofile:
         print('* 2D - ' + metal + ' to ' + conductor, file=ofile)
         print('* FasterCap input file: ' + filename, file=ofile)
         print('* Instantiates one ' + metal + ' wire of width ' + swidth, file=ofile)
@@ -360,6 +365,10 @@ def generate_one_wire_file(filename, conductor, metal, width, pstack):
         for line in extra:
             print(line, file=ofile)
 
+        # Write the file out in one piece
+        with open(filename, 'w') as wfile:
+            wfile.write(ofile.getvalue())
+
 # --------------------------------------------------------
 # generate_1wire_2plane_file --
 #
@@ -406,7 +415,7 @@ def generate_1wire_2plane_file(filename, substrate, conductor, metal, width, pst
 
     swidth = "{:.2f}".format(width)
 
-    with open(filename, 'w') as ofile:
+    with io.StringIO() as ofile:
         print('* 2D - ' + metal + ' to ' + conductor, file=ofile)
         print('* FasterCap input file: ' + filename, file=ofile)
         print('* Instantiates one ' + metal + ' wire of width ' + swidth, file=ofile)
@@ -728,6 +737,10 @@ def generate_1wire_2plane_file(filename, substrate, conductor, metal, width, pst
         for line in extra:
             print(line, file=ofile)
 
+        # Write the file out in one piece
+        with open(filename, 'w') as wfile:
+            wfile.write(ofile.getvalue())
+
 # --------------------------------------------------------
 # generate_one_shielded_wire_file --
 #
@@ -786,7 +799,7 @@ def generate_one_shielded_wire_file(filename, substrate, conductor, metal, width
     sspace = "{:.2f}".format(spacing)
     sshwidth = "{:.2f}".format(shwidth)
 
-    with open(filename, 'w') as ofile:
+    with io.StringIO() as ofile:
         print('* 2D - ' + metal + ' to ' + conductor + ' over ' + substrate, file=ofile)
         print('* FasterCap input file: ' + filename, file=ofile)
         print('* Instantiates a ' + metal + ' wire of width ' + swidth, file=ofile)
@@ -1166,6 +1179,10 @@ def generate_one_shielded_wire_file(filename, substrate, conductor, metal, width
         for line in extra:
             print(line, file=ofile)
 
+        # Write the file out in one piece
+        with open(filename, 'w') as wfile:
+            wfile.write(ofile.getvalue())
+
 # --------------------------------------------------------
 # generate_two_wire_file --
 #
@@ -1212,7 +1229,7 @@ def generate_two_wire_file(filename, conductor, metal, width, spacing, pstack):
     swidth = "{:.2f}".format(width)
     sspace = "{:.2f}".format(spacing)
 
-    with open(filename, 'w') as ofile:
+    with io.StringIO() as ofile:
         print('* 2D - ' + metal + ' to ' + conductor, file=ofile)
         print('* FasterCap input file: ' + filename, file=ofile)
         print('* Instantiates two ' + metal + ' wires of width ' + swidth, file=ofile)
@@ -1557,6 +1574,10 @@ def generate_two_wire_file(filename, conductor, metal, width, spacing, pstack):
         for line in extra:
             print(line, file=ofile)
 
+        # Write the file out in one piece
+        with open(filename, 'w') as wfile:
+            wfile.write(ofile.getvalue())
+
 # --------------------------------------------------------
 # generate_two_offset_wire_file --
 #
@@ -1613,7 +1634,7 @@ def generate_two_offset_wire_file(filename, substrate, conductor, cwidth, metal,
     sspace = "{:.2f}".format(spacing)
     scwidth = "{:.2f}".format(cwidth)
 
-    with open(filename, 'w') as ofile:
+    with io.StringIO() as ofile:
         print('* 2D - ' + metal + ' to ' + conductor + ' over ' + substrate, file=ofile)
         print('* FasterCap input file: ' + filename, file=ofile)
         print('* Instantiates a ' + metal + ' wire of width ' + swidth, file=ofile)
@@ -1995,3 +2016,58 @@ def generate_two_offset_wire_file(filename, substrate, conductor, cwidth, metal,
         for line in extra:
             print(line, file=ofile)
 
+        # Write the file out in one piece
+        with open(filename, 'w') as wfile:
+            wfile.write(ofile.getvalue())
+
+# --------------------------------------------------------
+# generate_files --
+#
+# Procedure to call one of the generator routines above
+# for each entry in a list of tasks.  Each task is a tuple
+# of the arguments to the generator routine.  Each file is
+# independent of the others, so large batches are spread
+# across a pool of processes.  Small batches are generated
+# directly, as the pool startup would cost more than it
+# saves.
+#
+# The process stack (the last argument of every generator
+# routine) is the same for many tasks, so the distinct stacks
+# are handed to each worker process once when it starts (with
+# the "fork" start method, they are simply inherited), and
+# each task carries only an index into that list.
+#
+# Arguments:
+# (1) generator routine (e.g., generate_one_wire_file)
+# (2) list of argument tuples, one per file
+# --------------------------------------------------------
+
+# Process stacks shared by the tasks run in a worker process
+worker_stacks = []
+
+def set_worker_stacks(pstacks):
+    global worker_stacks
+    worker_stacks = pstacks
+
+def generate_with_stack(generator, *args):
+    generator(*args[:-1], worker_stacks[args[-1]])
+
+def generate_files(generator, tasks):
+    if len(tasks) < 16:
+        for task in tasks:
+            generator(*task)
+        return
+
+    pstacks = []
+    stackindex = {}
+    stacktasks = []
+    for task in tasks:
+        pstack = task[-1]
+        if id(pstack) not in stackindex:
+            stackindex[id(pstack)] = len(pstacks)
+            pstacks.append(pstack)
+        stacktasks.append(task[:-1] + (stackindex[id(pstack)],))
+
+    with ProcessPoolExecutor(initializer=set_worker_stacks, initargs=(pstacks,)) as executor:
+        list(executor.map(functools.partial(generate_with_stack, generator),
+		*zip(*stacktasks), chunksize=8))
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+#
+# load_stack.py --
+#
+#	Read a metal stack definition file.  The metal stack
+#	file is in the format of executable python, so it is
+#	compiled and run with exec(), and the variables it
+#	defines are returned as a dictionary.  The result is
+#	cached by absolute file name and modification time,
+#	so that the several build scripts run from one sweep
+#	do not each re-read and re-compile the same file.
+#
+import os
+import functools
+
+@functools.lru_cache(maxsize=8)
+def load_stack_cached(stackupfile, mtime):
+    with open(stackupfile, 'r') as ifile:
+        code = compile(ifile.read(), stackupfile, 'exec')
+    # The file is run with a single dictionary as its namespace,
+    # so that any function it defines can see the other names
+    # defined at the top level of the file.
+    stackvars = {}
+    exec(code, stackvars)
+    del stackvars['__builtins__']
+    return stackvars
+
+#--------------------------------------------------------------
+# Return a dictionary of the variables (e.g., "process",
+# "layers", "limits") defined by the metal stack file.
+# Raises an exception if the file cannot be read or run.
+#--------------------------------------------------------------
+
+def load_stack(stackupfile):
+    stackupfile = os.path.abspath(stackupfile)
+    mtime = os.path.getmtime(stackupfile)
+    return load_stack_cached(stackupfile, mtime).copy()
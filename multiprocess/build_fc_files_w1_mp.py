@@ -14,324 +14,243 @@
 #
 import os
 import sys
-import numpy
-import subprocess
-import multiprocessing
 
 # Local files
+from load_stack import load_stack
+import generate_geometry
 from ordered_stack import ordered_stack
-from generate_geometry import generate_one_wire_file
+from sweep_range import sweep_range
+from fc_args import build_parser, comma_list
+from generate_geometry import generate_one_wire_file, generate_files
+from run_fastercap import run_fastercap_batch, fastercap_dir
 
-#--------------------------------------------------------------
-# Usage statement
-#--------------------------------------------------------------
-
-def usage():
-    print('Usage:  build_fc_files_w1_mp.py <stack_def_file> [options]')
-    print('  Where [options] may be one or more of:')
-    print('     -metals=<metal>[,...]  (restrict wire type to one or more metals)')
-    print('     -conductors=<conductor>[,...] (restrict conductor type to one or more types)')
-    print('     -width=<start>,<stop>,<step> (wire width range, in microns)')
-    print('     -tol[erance]=<value>         (FasterCap tolerance)')
-    print('     -file=<name>                 (output filename for results)')
-
-#---------------------------------------------------
-# 1. Get arguments
-#---------------------------------------------------
-
-options = []
-arguments = []
-for item in sys.argv[1:]:
-    if item.find('-', 0) == 0:
-        options.append(item)
-    else:
-        arguments.append(item)
-
-if len(arguments) != 1:
-    print('Argument length is ' + str(len(arguments)))
-    usage()
-    sys.exit(1)
-
-metallist = []
-condlist = []
-use_default_width = True
-wstart = 0
-wstop = 0
-wstep = 0
-outfile = 'results/w1_results.txt'
-verbose = 0
-tolerance = 0.01
-
-for option in options:
-    tokens = option.split('=')
-    if len(tokens) != 2:
-        print('Error:  Option "' + option + '":  Option must be in form "-key=<value>".')
-        usage()
-        continue
-    if tokens[0] == '-file':
-        outfile = tokens[1]
-    elif tokens[0] == '-verbose':
-        try:
-            verbose = int(tokens[1])
-        except:
-            print('Error:  Verbose level "' + tokens[1] + '" is not numeric.')
-            continue
-    elif tokens[0] == '-tol' or tokens[0] == '-tolerance':
-        try:
-            tolerance = float(tokens[1])
-        except:
-            print('Error:  Tolerance "' + tokens[1] + '" is not numeric.')
-            continue
-    elif tokens[0] == '-metals':
-        metallist = tokens[1].split(',')
-    elif tokens[0] == '-conductors':
-        condlist = tokens[1].split(',')
-    elif tokens[0] == '-width':
-        rangelist = tokens[1].split(',')
-        if len(rangelist) != 3:
-            print('Error:  Wire width needs three comma-separated values')
-            usage()
-            continue
-        optstr = rangelist[0].replace('um','')
-        try:
-            wstart = float(optstr)
-        except:
-            print('Error:  Wire width start value "' + optstr + '" is not numeric.')
-            continue
-        optstr = rangelist[1].replace('um','')
-        try:
-            wstop = float(optstr)
-        except:
-            print('Error:  Wire width end value "' + optstr + '" is not numeric.')
-            continue
-        optstr = rangelist[2].replace('um','')
-        try:
-            wstep = float(optstr)
-        except:
-            print('Error:  Wire width step value "' + optstr + '" is not numeric.')
-            continue
-        use_default_width = False
-    else:
-        print('Error:  Unknown option "' + option + '"')
-        usage()
-        continue
+# Translation table for turning a width like 1.50 into "1p50" in filenames
+wspec_trans = str.maketrans('.', 'p')
 
 #--------------------------------------------------------------
-# 2. Obtain the metal stack.  The metal stack file is in the
-#    format of executable python, so use exec().
+# The main routine.  All of the work is done here rather than at
+# the top level of the script, so that processes started by the
+# "spawn" method (the default on macOS and Windows), which import
+# this file, do not re-run the script.
 #--------------------------------------------------------------
 
-try:
-    exec(open(arguments[0], 'r').read())
-except:
-    print('Error:  No metal stack file ' + arguments[0] + '!')
-    sys.exit(1)
-
-try:
-    process
-except:
-    print('Warning:  Metal stack does not define process!')
-    process = 'unknown'
-
-try:
-    layers
-except:
-    print('Error:  Metal stack does not define layers!')
-    sys.exit(1)
-
-try:
-    limits
-except:
-    print('Error:  Metal stack does not define limits!')
-    sys.exit(1)
-
-#--------------------------------------------------------------
-# 3. Generate files
-#--------------------------------------------------------------
-
-# "metals" is a reorganization of the full stack list to include
-# just the metal layers and their heights and thicknesses.
-
-metals = []
-for lname, layer in layers.items():
-    if layer[0] == 'm':
-        metals.append(lname)
-
-substrates = []
-for lname, layer in layers.items():
-    if layer[0] == 'd':
-        substrates.append(lname)
-
-# Check options
-
-for metal in metallist.copy():
-    if metal not in metals:
-        print('Error:  Wire metal "' + metal + '" is not in the stackup!')
-        metallist.remove(metal)
-
-for conductor in condlist.copy():
-    if conductor not in substrates and conductor not in metals:
-        print('Error:  Conductor type "' + conductor + '" is not in the stackup!')
-        condlist.remove(conductor)
-
-# Set default values if not specified in options
-
-if metallist == []:
-    print('Using all metals in stackup for set of wire types to test')
-    metallist = metals
+def main():
 
-if condlist == []:
-    print('Using all substrates and metals in stackup for set of substrate types to test')
-    condlist = substrates.copy()
+    #---------------------------------------------------
+    # 1. Get arguments
+    #---------------------------------------------------
 
-if verbose > 0:
-    print('Simulation parameters:')
-    print('   Wire width start = ' + str(wstart) + ', stop = ' + str(wstop) + ', step = ' + str(wstep))
-    print('')
+    parser = build_parser('build_fc_files_w1_mp.py', 'results/w1_results.txt')
+    parser.add_argument('-conductors', metavar='<conductor>[,...]', type=comma_list, default=[],
+		help='restrict conductor type to one or more types')
+    parser.add_argument('-incremental', action='store_true',
+		help='keep input files newer than the stack file')
+    args = parser.parse_args()
 
-# Make sure the working directory exists
-os.makedirs(process + '/fastercap_files/w1', exist_ok=True)
+    stackupfile = args.stackupfile
+    metallist = args.metals
+    condlist = args.conductors
+    outfile = args.outfile
+    verbose = args.verbose
+    tolerance = args.tolerance
+    incremental = args.incremental
 
-filelist = []
-for metal in metallist:
-
-    if condlist == []:
-        conductors = substrates.copy()
-        for lname, layer in layers.items():
-            if lname == metal:
-                break
-            elif layer[0] == 'm':
-                conductors.append(lname)
+    if args.width:
+        use_default_width = False
+        wstart, wstop, wstep = args.width
     else:
-        # Note:  This may need to be restricted
-        conductors = condlist.copy()
-
-    if use_default_width == True:
-        minwidth = limits[metal][0]
-        wstart = minwidth
-        wstop = 10 * minwidth + 0.5 * minwidth
-        wstep = 9 * minwidth
-
-    for conductor in conductors:
-        # Poly to diff is a transistor gate and is not a parasitic.
-        if 'poly' in metal and 'diff' in conductor:
-            continue
-
-        # Generate the stack for this particular combination of
-        # reference conductor and metal
-        pstack = ordered_stack(conductor, [metal], layers)
-
-        # (Diagnostic) Print out the stack
-        if verbose > 0:
-            print('Stackup for metal = ' + metal + ' and reference ' + conductor + ':')
-            for p in pstack:
-                print(str(p))
-            print('')
-
-        for width in numpy.arange(wstart, wstop, wstep):
-            wspec = "{:.2f}".format(width).replace('.', 'p')
-            filename = process + '/fastercap_files/w1/' + metal + '_' + conductor + '_w_' + wspec + '.lst'
-            generate_one_wire_file(filename, conductor, metal, width, pstack)
-            filelist.append(filename)
-
-#--------------------------------------------------------------
-# Subroutine for running FasterCap in a thread
-#--------------------------------------------------------------
+        use_default_width = True
+        wstart = wstop = wstep = 0
+
+    #--------------------------------------------------------------
+    # 2. Obtain the metal stack.  The metal stack file is in the
+    #    format of executable python (see load_stack.py).
+    #--------------------------------------------------------------
+
+    try:
+        stackvars = load_stack(stackupfile)
+    except:
+        print('Error:  No metal stack file ' + stackupfile + '!')
+        return 1
+
+    try:
+        process = stackvars['process']
+    except:
+        print('Warning:  Metal stack does not define process!')
+        process = 'unknown'
+
+    try:
+        layers = stackvars['layers']
+    except:
+        print('Error:  Metal stack does not define layers!')
+        return 1
+
+    try:
+        limits = stackvars['limits']
+    except:
+        print('Error:  Metal stack does not define limits!')
+        return 1
+
+    #--------------------------------------------------------------
+    # 3. Generate files
+    #--------------------------------------------------------------
+
+    # "metals" is a reorganization of the full stack list to include
+    # just the metal layers and their heights and thicknesses.
+    # "lower_metals" is a dictionary giving, for each metal, the list
+    # of metals below it in the stack.
+
+    metals = []
+    substrates = []
+    lower_metals = {}
+    for lname, layer in layers.items():
+        if layer[0] == 'm':
+            lower_metals[lname] = metals.copy()
+            metals.append(lname)
+        elif layer[0] == 'd':
+            substrates.append(lname)
+
+    # Check options
+
+    for metal in metallist.copy():
+        if metal not in metals:
+            print('Error:  Wire metal "' + metal + '" is not in the stackup!')
+            metallist.remove(metal)
+
+    for conductor in condlist.copy():
+        if conductor not in substrates and conductor not in metals:
+            print('Error:  Conductor type "' + conductor + '" is not in the stackup!')
+            condlist.remove(conductor)
+
+    # Set default values if not specified in options
+
+    if metallist == []:
+        print('Using all metals in stackup for set of wire types to test')
+        metallist = metals
 
-def run_fastercap(file, tolerance):
-    loctol = tolerance
-    fastercapexec = '/home/tim/src/FasterCap_6.0.7/FasterCap'
-
-    print('Running FasterCap on input file ' + file)
-    done = False
-    while not done:
-        tolspec = "-a{:.3f}".format(loctol)
-        try:
-            proc = subprocess.run([fastercapexec, '-b', file, tolspec],
-			stdin = subprocess.DEVNULL,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,
-			universal_newlines = True,
-                	timeout = 30)
-        except subprocess.TimeoutExpired:
-            if loctol > 0.1:
-                print('ERROR:  Failing with high tolerance;  bailing.')
-                break
-            loctol *= 2
-            if verbose > 0:
-                print('Trying again with tolerance = ' + '{:.3f}'.format(loctol))
+    if condlist == []:
+        print('Using all substrates and metals in stackup for set of substrate types to test')
+        condlist = substrates.copy()
+
+    if verbose > 0:
+        print('Simulation parameters:')
+        print('   Wire width start = ' + str(wstart) + ', stop = ' + str(wstop) + ', step = ' + str(wstep))
+        print('')
+
+    # Make sure the working directory exists
+    filedir = fastercap_dir(process, 'w1')
+    os.makedirs(filedir, exist_ok=True)
+
+    # Input files are out of date if older than either the stack
+    # file or the geometry generator.
+    if incremental:
+        srctime = max(os.path.getmtime(stackupfile),
+		os.path.getmtime(generate_geometry.__file__))
+
+    # Each FasterCap input file and the (metal, conductor, width)
+    # parameters it was generated from.
+    filelist = []
+    fileparams = []
+    tasks = []
+    for metal in metallist:
+
+        if condlist == []:
+            conductors = substrates + lower_metals[metal]
         else:
-            done = True
-            if loctol > 0.01:
-                print('WARNING:  High tolerance value (' + tolspec + ') used.')
-
-    if proc.stdout:
-        if verbose > 1:
-            print('Diagnostic output from FasterCap:')
-        for line in proc.stdout.splitlines():
-            if verbose > 1:
-                print(line)
-            if 'g1_' in line:
-                g1line = line.split()
-                g0 = float(g1line[1])
-    if proc.stderr:
-        print('Error message output from FasterCap:')
-        for line in proc.stderr.splitlines():
-            print(line)
-        if proc.returncode != 0:
-            print('ERROR:  FasterCap exited with status ' + str(proc.returncode))
-
-    elif done:
-        csub = g0
-        ssub = "{:.5g}".format(csub)
-        print('Result:  Csub=' + ssub)
-
-        # Add to results
-        fileroot = os.path.splitext(file)[0]
-        filename = os.path.split(fileroot)[-1]
-        values = filename.split('_')
-        metal = values[0]
-        conductor = values[1]
-        width = float(values[3].replace('p', '.'))
-        return (metal, conductor, width, csub)
-
-    return None
+            # Note:  This may need to be restricted
+            conductors = condlist.copy()
 
-#--------------------------------------------------------------
-# 4. Simulate with fastercap
-#--------------------------------------------------------------
+        if use_default_width == True:
+            minwidth = limits[metal][0]
+            wstart = minwidth
+            wstop = 10 * minwidth + 0.5 * minwidth
+            wstep = 9 * minwidth
 
-presults = []
-with multiprocessing.Pool() as pool:
-    results = []
-    for file in filelist:
-        results.append(pool.apply_async(run_fastercap, (file, tolerance),))
+        widths = sweep_range(wstart, wstop, wstep)
 
-    for result in results:
-        presult = result.get(timeout=300)
-        if presult:
-            presults.append(presult)
+        for conductor in conductors:
+            # Poly to diff is a transistor gate and is not a parasitic.
+            if 'poly' in metal and 'diff' in conductor:
+                continue
 
-#--------------------------------------------------------------
-# 5. Save (and print) results
-#--------------------------------------------------------------
-
-if len(presults) == 0:
-    print('No results to save or print.')
-    sys.exit(0)
-
-# Make sure the output directory exists
-outdir = os.path.split(outfile)[0]
-if outdir != '':
-    os.makedirs(outdir, exist_ok=True)
+            # Generate the stack for this particular combination of
+            # reference conductor and metal
+            pstack = ordered_stack(conductor, [metal], layers)
 
-print('Results:')
-with open(outfile, 'w') as ofile:
+            # (Diagnostic) Print out the stack
+            if verbose > 0:
+                print('Stackup for metal = ' + metal + ' and reference ' + conductor + ':')
+                for p in pstack:
+                    print(str(p))
+                print('')
+
+            for width in widths:
+                wspec = f'{width:.2f}'.translate(wspec_trans)
+                filename = filedir + '/' + metal + '_' + conductor + '_w_' + wspec + '.lst'
+                filelist.append(filename)
+                fileparams.append((metal, conductor, width))
+                if incremental and os.path.isfile(filename):
+                    if os.path.getmtime(filename) > srctime:
+                        continue
+                tasks.append((filename, conductor, metal, width, pstack))
+
+    # Write out all of the FasterCap input files
+    generate_files(generate_one_wire_file, tasks)
+
+    #--------------------------------------------------------------
+    # 4. Simulate with fastercap
+    #--------------------------------------------------------------
+
+    def print_result(i, gmatrix):
+        if gmatrix:
+            ssub = "{:.5g}".format(gmatrix[0][0])
+            print('Result:  Csub=' + ssub)
+
+    # FasterCap runs are overseen by asyncio from this process (see
+    # run_fastercap_batch()), widest geometries first.
+
+    widthlist = [width for metal, conductor, width in fileparams]
+    gmatrices = run_fastercap_batch(filelist, tolerance, verbose, widthlist,
+		callback=print_result)
+
+    presults = []
+    for (metal, conductor, width), gmatrix in zip(fileparams, gmatrices):
+        if gmatrix:
+            csub = gmatrix[0][0]
+            presults.append((metal, conductor, width, csub))
+
+    #--------------------------------------------------------------
+    # 5. Save (and print) results
+    #--------------------------------------------------------------
+
+    if len(presults) == 0:
+        print('No results to save or print.')
+        return 0
+
+    # Make sure the output directory exists
+    outdir = os.path.split(outfile)[0]
+    if outdir != '':
+        os.makedirs(outdir, exist_ok=True)
+
+    results = ''
     for presult in presults:
         metal = presult[0]
         conductor = presult[1]
         swidth = "{:.4f}".format(presult[2])
         ssub = "{:.5g}".format(presult[3])
-        print(metal + ' ' + conductor + ' ' + swidth + ' ' + ssub, file=ofile)
-        print(metal + ' ' + conductor + ' ' + swidth + ' ' + ssub)
+        results += metal + ' ' + conductor + ' ' + swidth + ' ' + ssub + '\n'
+
+    with open(outfile, 'w') as ofile:
+        ofile.write(results)
+
+    print('Results:')
+    print(results, end='')
+
+    return 0
+
+#---------------------------------------------------
+# Invoke build_fc_files_w1_mp.py as an application
+#---------------------------------------------------
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,367 +14,274 @@
 #
 import os
 import sys
-import numpy
-import subprocess
-import multiprocessing
 
 # Local files
+from load_stack import load_stack
 from ordered_stack import ordered_stack
-from generate_geometry import generate_two_wire_file
+from sweep_range import sweep_range
+from fc_args import build_parser, comma_list, sweep_spec
+from generate_geometry import generate_two_wire_file, generate_files
+from run_fastercap import run_fastercap_batch, fastercap_dir
 
 #--------------------------------------------------------------
-# Usage statement
+# The main routine.  All of the work is done here rather than at
+# the top level of the script, so that processes started by the
+# "spawn" method (the default on macOS and Windows), which import
+# this file, do not re-run the script.
 #--------------------------------------------------------------
 
-def usage():
-    print('Usage:  build_fc_files_w2_mp.py <stack_def_file> [options]')
-    print('  Where [options] may be one or more of:')
-    print('     -metals=<metal>[,...]  (restrict wire type to one or more metals)')
-    print('     -sub[strate]=<substrate>[,...] (restrict substrate type)')
-    print('     -width=<start>,<stop>,<step> (wire width range, in microns)')
-    print('     -sep=<start>,<stop>,<step>   (separation range, in microns)')
-    print('     -tol[erance]=<value>         (FasterCap tolerance)')
-    print('     -file=<name>                 (output filename for results)')
+def main():
 
-#---------------------------------------------------
-# 1. Get arguments
-#---------------------------------------------------
-
-options = []
-arguments = []
-for item in sys.argv[1:]:
-    if item.find('-', 0) == 0:
-        options.append(item)
-    else:
-        arguments.append(item)
-
-if len(arguments) != 1:
-    print('Argument length is ' + str(len(arguments)))
-    usage()
-    sys.exit(1)
-
-metallist = []
-condlist = []
-use_default_width = True
-wstart = 0
-wstop = 0
-wstep = 0
-use_default_sep = True
-sstart = 0
-sstop = 0
-sstep = 0
-outfile = 'results/w2_results.txt'
-verbose = 0
-tolerance = 0.01
-
-for option in options:
-    tokens = option.split('=')
-    if len(tokens) != 2:
-        print('Error:  Option "' + option + '":  Option must be in form "-key=<value>".')
-        usage()
-        continue
-    if tokens[0] == '-file':
-        outfile = tokens[1]
-    elif tokens[0] == '-verbose':
-        try:
-            verbose = int(tokens[1])
-        except:
-            print('Error:  Verbose level "' + tokens[1] + '" is not numeric.')
-            continue
-    elif tokens[0] == '-tol' or tokens[0] == '-tolerance':
-        try:
-            tolerance = float(tokens[1])
-        except:
-            print('Error:  Tolerance "' + tokens[1] + '" is not numeric.')
-            continue
-    elif tokens[0] == '-metals':
-        metallist = tokens[1].split(',')
-    elif tokens[0].startswith('-sub') or tokens[0] == '-conductors':
-        condlist = tokens[1].split(',')
-    elif tokens[0] == '-width':
-        rangelist = tokens[1].split(',')
-        if len(rangelist) != 3:
-            print('Error:  Wire width needs three comma-separated values')
-            usage()
-            continue
-        optstr = rangelist[0].replace('um','')
-        try:
-            wstart = float(optstr)
-        except:
-            print('Error:  Wire width start value "' + optstr + '" is not numeric.')
-            continue
-        optstr = rangelist[1].replace('um','')
-        try:
-            wstop = float(optstr)
-        except:
-            print('Error:  Wire width end value "' + optstr + '" is not numeric.')
-            continue
-        optstr = rangelist[2].replace('um','')
-        try:
-            wstep = float(optstr)
-        except:
-            print('Error:  Wire width step value "' + optstr + '" is not numeric.')
-            continue
-        use_default_width = False
-    elif tokens[0] == '-sep':
-        rangelist = tokens[1].split(',')
-        if len(rangelist) != 3:
-            print('Error:  Separation needs three comma-separated values')
-            usage()
-            continue
-        optstr = rangelist[0].replace('um','')
-        try:
-            sstart = float(optstr)
-        except:
-            print('Error:  Separation start value "' + optstr + '" is not numeric.')
-            continue
-        optstr = rangelist[1].replace('um','')
-        try:
-            sstop = float(optstr)
-        except:
-            print('Error:  Separation end value "' + optstr + '" is not numeric.')
-            continue
-        optstr = rangelist[2].replace('um','')
-        try:
-           sstep = float(optstr)
-        except:
-            print('Error:  Separation step value "' + optstr + '" is not numeric.')
-            continue
-        use_default_sep = False
-    else:
-        print('Error:  Unknown option "' + option + '"')
-        usage()
-        continue
-
-#--------------------------------------------------------------
-# 2. Obtain the metal stack.  The metal stack file is in the
-#    format of executable python, so use exec().
-#--------------------------------------------------------------
-
-try:
-    exec(open(arguments[0], 'r').read())
-except:
-    print('Error:  No metal stack file ' + arguments[0] + '!')
-    sys.exit(1)
-
-try:
-    process
-except:
-    print('Warning:  Metal stack does not define process!')
-    process = 'unknown'
-
-try:
-    layers
-except:
-    print('Error:  Metal stack does not define layers!')
-    sys.exit(1)
-
-try:
-    limits
-except:
-    print('Error:  Metal stack does not define limits!')
-    sys.exit(1)
-
-#--------------------------------------------------------------
-# 3. Generate files
-#--------------------------------------------------------------
-
-# "metals" is a reorganization of the full stack list to include
-# just the metal layers and their heights and thicknesses.
-
-metals = []
-for lname, layer in layers.items():
-    if layer[0] == 'm':
-        metals.append(lname)
-
-substrates = []
-for lname, layer in layers.items():
-    if layer[0] == 'd':
-        substrates.append(lname)
+    #---------------------------------------------------
+    # 1. Get arguments
+    #---------------------------------------------------
 
-# Check options
+    parser = build_parser('build_fc_files_w2_mp.py', 'results/w2_results.txt')
+    parser.add_argument('-sub', '-substrate', '-conductors', metavar='<substrate>[,...]', dest='condlist',
+		type=comma_list, default=[], help='restrict substrate type')
+    parser.add_argument('-sep', metavar='<start>,<stop>,<step>', type=sweep_spec,
+		help='separation range, in microns')
+    args = parser.parse_args()
 
-for metal in metallist.copy():
-    if metal not in metals:
-        print('Error:  Wire metal "' + metal + '" is not in the stackup!')
-        metallist.remove(metal)
+    stackupfile = args.stackupfile
+    metallist = args.metals
+    condlist = args.condlist
+    outfile = args.outfile
+    verbose = args.verbose
+    tolerance = args.tolerance
 
-for conductor in condlist.copy():
-    if conductor not in substrates and conductor not in metals:
-        print('Error:  Substrate type "' + conductor + '" is not in the stackup!')
-        condlist.remove(conductor)
-
-# Set default values if not specified in options
-
-if metallist == []:
-    print('Using all metals in stackup for set of wire types to test')
-    metallist = metals
-
-if condlist == []:
-    print('Using all substrate types in stackup for set of types to test')
-    condlist = substrates.copy()
-
-if verbose > 0:
-    print('Simulation parameters:')
-    print('   Wire width start = ' + str(wstart) + ', stop = ' + str(wstop) + ', step = ' + str(wstep))
-    print('   Wire separation start = ' + str(sstart) + ', stop = ' + str(sstop) + ', step = ' + str(sstep))
-    print('')
-
-filelist = []
-
-# Make sure the working directory exists
-os.makedirs(process + '/fastercap_files/w2', exist_ok=True)
-
-for metal in metallist:
-
-    if use_default_width == True:
-        minwidth = limits[metal][0]
-        wstart = minwidth
-        wstop = 10 * minwidth + 0.5 * minwidth
-        wstep = 9 * minwidth
+    if args.width:
+        use_default_width = False
+        wstart, wstop, wstep = args.width
+    else:
+        use_default_width = True
+        wstart = wstop = wstep = 0
 
-    if use_default_sep == True:
-        minsep = limits[metal][1]
-        sstart = minsep
-        sstop = 10 * minsep + 0.5 * minsep
-        sstep = minsep
+    if args.sep:
+        use_default_sep = False
+        sstart, sstop, sstep = args.sep
+    else:
+        use_default_sep = True
+        sstart = sstop = sstep = 0
+
+    #--------------------------------------------------------------
+    # 2. Obtain the metal stack.  The metal stack file is in the
+    #    format of executable python (see load_stack.py).
+    #--------------------------------------------------------------
+
+    try:
+        stackvars = load_stack(stackupfile)
+    except:
+        print('Error:  No metal stack file ' + stackupfile + '!')
+        return 1
+
+    try:
+        process = stackvars['process']
+    except:
+        print('Warning:  Metal stack does not define process!')
+        process = 'unknown'
+
+    try:
+        layers = stackvars['layers']
+    except:
+        print('Error:  Metal stack does not define layers!')
+        return 1
+
+    try:
+        limits = stackvars['limits']
+    except:
+        print('Error:  Metal stack does not define limits!')
+        return 1
+
+    #--------------------------------------------------------------
+    # 3. Generate files
+    #--------------------------------------------------------------
+
+    # "metals" is a reorganization of the full stack list to include
+    # just the metal layers and their heights and thicknesses, and
+    # "substrates" the ground plane (diffusion) layers.  Both are
+    # picked out in one pass over the stack.
+
+    metals = []
+    substrates = []
+    for lname, layer in layers.items():
+        if layer[0] == 'm':
+            metals.append(lname)
+        elif layer[0] == 'd':
+            substrates.append(lname)
+
+    # Check options
+
+    metalset = set(metals)
+    condset = metalset.union(substrates)
+
+    for metal in metallist:
+        if metal not in metalset:
+            print('Error:  Wire metal "' + metal + '" is not in the stackup!')
+    metallist = [metal for metal in metallist if metal in metalset]
 
     for conductor in condlist:
-
-        # Poly to diff is a transistor gate and is not a parasitic.
-        if 'poly' in metal and 'diff' in conductor:
+        if conductor not in condset:
+            print('Error:  Substrate type "' + conductor + '" is not in the stackup!')
+    condlist = [conductor for conductor in condlist if conductor in condset]
+
+    # Set default values if not specified in options
+
+    if metallist == []:
+        print('Using all metals in stackup for set of wire types to test')
+        metallist = metals
+
+    if condlist == []:
+        print('Using all substrate types in stackup for set of types to test')
+        condlist = substrates.copy()
+
+    if verbose > 0:
+        print('Simulation parameters:')
+        print('   Wire width start = ' + str(wstart) + ', stop = ' + str(wstop) + ', step = ' + str(wstep))
+        print('   Wire separation start = ' + str(sstart) + ', stop = ' + str(sstop) + ', step = ' + str(sstep))
+        print('')
+
+    # Each FasterCap input file and the (metal, conductor, width,
+    # separation) parameters it was generated from.
+    filelist = []
+    fileparams = []
+    tasks = []
+
+    # Make sure the working directory exists
+    filedir = fastercap_dir(process, 'w2')
+    os.makedirs(filedir, exist_ok=True)
+
+    # Widths and separations to test are the same for every metal unless
+    # the defaults (which depend on the metal's minimum width and spacing)
+    # are used.
+    if use_default_width == False:
+        widths = sweep_range(wstart, wstop, wstep)
+    if use_default_sep == False:
+        seps = sweep_range(sstart, sstop, sstep)
+
+    for metal in metallist:
+
+        # Poly to diff is a transistor gate and is not a parasitic.  Skip
+        # the metal entirely if that leaves no reference conductor.
+        conductors = [conductor for conductor in condlist if not ('poly' in metal and 'diff' in conductor)]
+        if conductors == []:
             continue
 
-        # Generate the stack for this particular combination of
-        # reference conductor and metal
-        pstack = ordered_stack(conductor, [metal], layers)
-
-        # (Diagnostic) Print out the stack
-        if verbose > 0:
-            print('Stackup for metal = ' + metal + ' and reference ' + conductor + ':')
-            for p in pstack:
-                print(str(p))
-            print('')
-
-        for separation in numpy.arange(sstart, sstop, sstep):
-            sspec = "{:.2f}".format(separation).replace('.', 'p')
-            for width in numpy.arange(wstart, wstop, wstep):
-                wspec = "{:.2f}".format(width).replace('.', 'p')
-                filename = process + '/fastercap_files/w2/' + metal + '_' + conductor + '_w_' + wspec + '_s_' + sspec + '.lst'
-                spacing = separation + width
-                generate_two_wire_file(filename, conductor, metal, width, spacing, pstack)
-                filelist.append(filename)
-
-#--------------------------------------------------------------
-# Routine for running FasterCap in thread
-#--------------------------------------------------------------
-
-def run_fastercap(file, tolerance):
-    loctol = tolerance
-    fastercapexec = '/home/tim/src/FasterCap_6.0.7/FasterCap'
-
-    print('Running FasterCap on input file ' + file)
-    done = False
-    while not done:
-        tolspec = "-a{:.3f}".format(loctol)
-        try:
-            proc = subprocess.run([fastercapexec, '-b', file, tolspec],
-			stdin = subprocess.DEVNULL,
-			stdout = subprocess.PIPE,
-			stderr = subprocess.PIPE,
-			universal_newlines = True,
-                	timeout = 30)
-        except subprocess.TimeoutExpired:
-            if loctol > 0.1:
-                print('ERROR:  Failing with high tolerance;  bailing.')
-                break
-            loctol *= 2
+        if use_default_width == True:
+            minwidth = limits[metal][0]
+            wstart = minwidth
+            wstop = 10 * minwidth + 0.5 * minwidth
+            wstep = 9 * minwidth
+            widths = sweep_range(wstart, wstop, wstep)
+
+        if use_default_sep == True:
+            minsep = limits[metal][1]
+            sstart = minsep
+            sstop = 10 * minsep + 0.5 * minsep
+            sstep = minsep
+            seps = sweep_range(sstart, sstop, sstep)
+
+        # Filename tags for each width and separation, shared by all
+        # conductors
+        wspecs = ["{:.2f}".format(width).replace('.', 'p') for width in widths]
+        sspecs = ["{:.2f}".format(separation).replace('.', 'p') for separation in seps]
+
+        for conductor in conductors:
+            # Generate the stack for this particular combination of
+            # reference conductor and metal
+            pstack = ordered_stack(conductor, [metal], layers)
+
+            # (Diagnostic) Print out the stack
             if verbose > 0:
-                print('Trying again with tolerance = ' + '{:.3f}'.format(loctol))
-        else:
-            done = True
-            if loctol > 0.01:
-                print('WARNING:  High tolerance value (' + tolspec + ') used.')
-
-    if proc.stdout:
-        if verbose > 1:
-            print('Diagnostic output from FasterCap:')
-        for line in proc.stdout.splitlines():
-            if verbose > 1:
-                print(line)
-            if 'g1_' in line:
-                g1line = line.split()
-                g00 = float(g1line[1])
-                g01 = float(g1line[2])
-            elif 'g2_' in line:
-                g2line = line.split()
-                g10 = float(g2line[1])
-                g11 = float(g2line[2])
-    if proc.stderr:
-        print('Error message output from FasterCap:')
-        for line in proc.stderr.splitlines():
-            print(line)
-        if proc.returncode != 0:
-            print('ERROR:  FasterCap exited with status ' + str(proc.returncode))
-
-    elif done:
-        cdiag = (g00 + g11) / 2
-        ccoup = -(g01 + g10) / 2
-        csub = cdiag - ccoup
-
-        scoup = "{:.5g}".format(ccoup)
-        ssub = "{:.5g}".format(csub)
-        print('Result:  Ccoup=' + scoup + '  Csub=' + ssub)
-
-        # Add to results
-        fileroot = os.path.splitext(file)[0]
-        filename = os.path.split(fileroot)[-1]
-        values = filename.split('_')
-        metal = values[0]
-        conductor = values[1]
-        width = float(values[3].replace('p', '.'))
-        sep = float(values[5].replace('p', '.'))
-        return (metal, conductor, width, sep, csub, ccoup)
-
-    return None
-
-#--------------------------------------------------------------
-# 4. Simulate with fastercap (multithreaded)
-#--------------------------------------------------------------
-
-presults = []
-with multiprocessing.Pool() as pool:
-    results = []
-    for file in filelist:
-        results.append(pool.apply_async(run_fastercap, (file, tolerance),))
+                print('Stackup for metal = ' + metal + ' and reference ' + conductor + ':')
+                for p in pstack:
+                    print(str(p))
+                print('')
+
+            # Part of the file name shared by every file for this pair
+            fileprefix = f'{filedir}/{metal}_{conductor}_w_'
+
+            for separation, sspec in zip(seps, sspecs):
+                for width, wspec in zip(widths, wspecs):
+                    filename = f'{fileprefix}{wspec}_s_{sspec}.lst'
+                    spacing = separation + width
+                    filelist.append(filename)
+                    fileparams.append((metal, conductor, width, separation))
+                    tasks.append((filename, conductor, metal, width, spacing, pstack))
+
+    # Write out all of the FasterCap input files
+    generate_files(generate_two_wire_file, tasks)
+
+    #--------------------------------------------------------------
+    # 4. Simulate with fastercap
+    #--------------------------------------------------------------
+
+    if tolerance == 0:
+        print('Tolerance set to zero;  skipping FasterCap run')
+        return 0
+
+    # Results are written to "<outfile>.part" as they come in, so
+    # that the results so far are kept if the run is interrupted.
+    # When the run is complete, the results are written again in
+    # sweep order, and the file is renamed to "outfile".
+
+    # Make sure the output directory exists
+    outdir = os.path.split(outfile)[0]
+    if outdir != '':
+        os.makedirs(outdir, exist_ok=True)
+
+    presults = {}
+
+    def save_result(i, gmatrix):
+        if gmatrix:
+            metal, conductor, width, sep = fileparams[i]
+            g00, g01 = gmatrix[0][0:2]
+            g10, g11 = gmatrix[1][0:2]
+            cdiag = (g00 + g11) / 2
+            ccoup = -(g01 + g10) / 2
+            csub = cdiag - ccoup
+
+            scoup = "{:.5g}".format(ccoup)
+            ssub = "{:.5g}".format(csub)
+            print('Result:  Ccoup=' + scoup + '  Csub=' + ssub)
+
+            swidth = "{:.4f}".format(width)
+            ssep = "{:.4f}".format(sep)
+            presult = metal + ' ' + conductor + ' ' + swidth + ' ' + ssep + ' ' + ssub + ' ' + scoup
+            presults[i] = presult
+            print(presult, file=ofile, flush=True)
+
+    # FasterCap runs are overseen by asyncio from this process (see
+    # run_fastercap_batch()), largest geometries (two wires and the
+    # space between them) first.
+
+    sizelist = [2 * width + sep for metal, conductor, width, sep in fileparams]
+    with open(outfile + '.part', 'w') as ofile:
+        run_fastercap_batch(filelist, tolerance, verbose, sizelist, callback=save_result)
+
+    #--------------------------------------------------------------
+    # 5. Save (and print) results
+    #--------------------------------------------------------------
+
+    if len(presults) == 0:
+        print('No results to save or print.')
+        os.remove(outfile + '.part')
+        return 0
+
+    results = ''.join(presults[i] + '\n' for i in sorted(presults))
+
+    with open(outfile + '.part', 'w') as ofile:
+        ofile.write(results)
+    os.replace(outfile + '.part', outfile)
+
+    print('Results:')
+    print(results, end='')
+
+    return 0
 
-    for result in results:
-        presult = result.get(timeout=300)
-        if presult:
-            presults.append(presult)
-
-#--------------------------------------------------------------
-# 5. Save (and print) results
-#--------------------------------------------------------------
-
-if len(presults) == 0:
-    print('No results to save or print.')
-    sys.exit(0)
-
-# Make sure the output directory exists
-outdir = os.path.split(outfile)[0]
-if outdir != '':
-    os.makedirs(outdir, exist_ok=True)
-
-print('Results:')
-with open(outfile, 'w') as ofile:
-    for presult in presults:
-        metal = presult[0]
-        conductor = presult[1]
-        swidth = "{:.4f}".format(presult[2])
-        ssep = "{:.4f}".format(presult[3])
-        ssub = "{:.5g}".format(presult[4])
-        scoup = "{:.5g}".format(presult[5])
-        print(metal + ' ' + conductor + ' ' + swidth + ' ' + ssep + ' ' + ssub + ' ' + scoup, file=ofile)
-        print(metal + ' ' + conductor + ' ' + swidth + ' ' + ssep + ' ' + ssub + ' ' + scoup)
+#---------------------------------------------------
+# Invoke build_fc_files_w2_mp.py as an application
+#---------------------------------------------------
 
+if __name__ == '__main__':
+    sys.exit(main())
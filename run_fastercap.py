@@ -0,0 +1,618 @@
+#!/usr/bin/env python3
+#
+# run_fastercap.py --
+#
+#	Routines for running FasterCap on a geometry input
+#	file and collecting the capacitance matrix from its
+#	output.  Results are memoized in a small database
+#	kept alongside the input files, keyed by a hash of
+#	the input file geometry and the tolerance, so that
+#	repeated parameter sweeps do not re-run FasterCap on
+#	geometries that have already been simulated.
+#
+#	Each routine has an asyncio counterpart (with the suffix
+#	"_async") so that a single process can oversee several
+#	FasterCap runs at once.
+#
+import os
+import re
+import json
+import shutil
+import signal
+import sqlite3
+import asyncio
+import hashlib
+import functools
+import tempfile
+import threading
+import subprocess
+
+# Rows of the capacitance matrix in FasterCap output have the
+# form "g<n>_<conductor> <value> <value> ...".  The pattern is
+# matched against the raw (undecoded) output.
+
+gline_re = re.compile(rb'^[ \t]*g(\d+)_\S*[ \t]+(.*)$', re.MULTILINE)
+
+# Rough estimate of the memory used by one FasterCap process, in
+# bytes, used to limit the number of runs at once.
+
+fastercap_memory = 1 << 30
+
+#--------------------------------------------------------------
+# Return the directory in which to write FasterCap input files
+# of type "subdir" (e.g., "w1") for process "process".  This is
+# normally "<process>/fastercap_files/<subdir>".  The input files
+# are only read back by FasterCap, so if the environment variable
+# CAPICHE_TMPDIR is set, they are written under that directory
+# instead (e.g., a RAM-backed tmpfs, to avoid network filesystem
+# round trips).  If CAPICHE_TMPDIR is "auto", a per-user
+# directory in /dev/shm is used (or in the system temporary
+# directory if there is no /dev/shm).  The result cache is kept
+# with the input files, so it lasts as long as that directory.
+#--------------------------------------------------------------
+
+def fastercap_dir(process, subdir):
+    tmpdir = os.getenv('CAPICHE_TMPDIR')
+    if not tmpdir:
+        return process + '/fastercap_files/' + subdir
+
+    if tmpdir == 'auto':
+        shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        tmpdir = os.path.join(shmdir, 'capiche-' + str(os.getuid()))
+
+    return os.path.join(tmpdir, process, 'fastercap_files', subdir)
+
+#--------------------------------------------------------------
+# Scan a block of raw FasterCap output for capacitance matrix
+# rows, and record them in the dictionary "grows", keyed by
+# row number.  "partial" is any incomplete line left over from
+# the previous block.  Only complete lines are scanned, and the
+# incomplete last line is returned, to be passed back in with
+# the next block (or with an empty block at the end of the
+# output).  If FasterCap prints the matrix more than once, the
+# last one printed is the final result.
+#--------------------------------------------------------------
+
+def scan_fastercap_block(block, partial, grows, verbose=0):
+    if block:
+        text, newline, partial = (partial + block).rpartition(b'\n')
+        text += newline
+    else:
+        text, partial = partial, b''
+
+    if text:
+        if verbose > 1:
+            print(text.decode(), end='')
+        for gmatch in gline_re.finditer(text):
+            grows[int(gmatch.group(1))] = [float(value) for value in gmatch.group(2).split()]
+
+    return partial
+
+#--------------------------------------------------------------
+# Run the FasterCap command "command" and scan its output as
+# it is produced, so that the full output is never held in
+# memory.  Returns a dictionary of capacitance matrix rows
+# keyed by row number, the text of any error output, and the
+# FasterCap exit status.  If FasterCap runs for longer than
+# "timeout" seconds, it is killed and subprocess.TimeoutExpired
+# is raised.  Error output is discarded at verbose level 0
+# (only the exit status is reported).
+#
+# The output is always read to the end.  With automatic
+# refinement ("-a"), the capacitance matrix may be printed
+# more than once, and only the last one is final, so the run
+# is not cut short when the first complete matrix appears.
+#--------------------------------------------------------------
+
+def stream_fastercap(command, timeout, verbose=0):
+    proc = subprocess.Popen(command,
+		stdin = subprocess.DEVNULL,
+		stdout = subprocess.PIPE,
+		stderr = subprocess.PIPE if verbose > 0 else subprocess.DEVNULL,
+		close_fds = False)
+
+    # Error output is collected in a separate thread so that
+    # neither pipe can fill up and stall FasterCap.  Killing
+    # FasterCap on timeout closes both pipes, which ends the
+    # read loops.
+    errlines = []
+    if proc.stderr:
+        errthread = threading.Thread(target=lambda: errlines.extend(proc.stderr))
+        errthread.start()
+
+    # The timer may still fire after FasterCap has exited on its
+    # own, so the run only counts as timed out if the timer fired
+    # and FasterCap was in fact killed by it.
+    killed = threading.Event()
+    def kill():
+        killed.set()
+        proc.kill()
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+
+    if verbose > 1:
+        print('Diagnostic output from FasterCap:')
+
+    # Output is read in blocks of whatever is available (up to
+    # 64 KiB), and each block is scanned with one regular
+    # expression search, rather than handling it line by line.
+    grows = {}
+    partial = b''
+    while True:
+        block = proc.stdout.read1(65536)
+        partial = scan_fastercap_block(block, partial, grows, verbose)
+        if not block:
+            break
+
+    proc.wait()
+    if proc.stderr:
+        errthread.join()
+        proc.stderr.close()
+    timer.cancel()
+    timer.join()
+    timed_out = killed.is_set() and proc.returncode == -signal.SIGKILL
+    proc.stdout.close()
+
+    if timed_out:
+        raise subprocess.TimeoutExpired(command, timeout)
+
+    return grows, b''.join(errlines).decode(), proc.returncode
+
+async def stream_fastercap_async(command, timeout, verbose=0):
+    proc = await asyncio.create_subprocess_exec(*command,
+		stdin = asyncio.subprocess.DEVNULL,
+		stdout = asyncio.subprocess.PIPE,
+		stderr = asyncio.subprocess.PIPE if verbose > 0 else asyncio.subprocess.DEVNULL,
+		close_fds = False)
+
+    # Output is read in large blocks rather than line by line, so
+    # that the event loop wakes up once per block for each of the
+    # FasterCap processes, not once per line of solver progress.
+    async def read_stdout():
+        if verbose > 1:
+            print('Diagnostic output from FasterCap:')
+        grows = {}
+        partial = b''
+        while True:
+            block = await proc.stdout.read(65536)
+            partial = scan_fastercap_block(block, partial, grows, verbose)
+            if not block:
+                break
+        return grows
+
+    async def read_stderr():
+        return await proc.stderr.read() if proc.stderr else b''
+
+    try:
+        grows, errtext, returncode = await asyncio.wait_for(
+		asyncio.gather(read_stdout(), read_stderr(), proc.wait()),
+		timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise subprocess.TimeoutExpired(command, timeout)
+
+    return grows, errtext.decode(), returncode
+
+#--------------------------------------------------------------
+# Return the full path of the FasterCap executable
+# "fastercapexec", searching the execution path only once.
+#--------------------------------------------------------------
+
+@functools.lru_cache(maxsize=None)
+def find_fastercap(fastercapexec):
+    return shutil.which(fastercapexec) or fastercapexec
+
+#--------------------------------------------------------------
+# Return the FasterCap command line for input file "file" at
+# tolerance "loctol".  FasterCap is named by its full path, so
+# that (together with close_fds=False, which is safe because
+# python opens all files as close-on-exec) python can start it
+# with posix_spawn() instead of copying this process first.
+#--------------------------------------------------------------
+
+def fastercap_command(file, loctol):
+    fastercapexec = os.getenv('FASTERCAP_EXEC')
+    if not fastercapexec:
+        fastercapexec = 'FasterCap'
+
+    return [find_fastercap(fastercapexec), '-b', file, "-a{:.3f}".format(loctol)]
+
+#--------------------------------------------------------------
+# Report any errors from a FasterCap run and assemble the
+# capacitance matrix rows into a list, in order.  Returns
+# None if there is no capacitance matrix.
+#--------------------------------------------------------------
+
+def fastercap_result(grows, errtext, returncode):
+    gmatrix = []
+    while len(gmatrix) + 1 in grows:
+        gmatrix.append(grows[len(gmatrix) + 1])
+
+    if errtext:
+        print('Error message output from FasterCap:')
+        print(errtext, end='')
+
+    if returncode != 0:
+        print('ERROR:  FasterCap exited with status ' + str(returncode))
+
+    if gmatrix == []:
+        print('ERROR:  No capacitance matrix found in FasterCap output.')
+        return None
+
+    return gmatrix
+
+#--------------------------------------------------------------
+# Print a warning if a result was found at a tolerance looser
+# than the default.
+#--------------------------------------------------------------
+
+def check_tolerance(loctol):
+    if loctol > 0.01:
+        print('WARNING:  High tolerance value (' + '{:.3f}'.format(loctol) + ') used.')
+
+#--------------------------------------------------------------
+# Run FasterCap on the input file "file" with the given
+# starting tolerance.  Returns the capacitance matrix as a
+# list of rows (one row for each "g<n>_" line of FasterCap
+# output), or None if FasterCap failed to produce a result,
+# along with the tolerance and exit status of the last
+# FasterCap run (the status is None if every run timed out).
+#
+# If FasterCap times out, it is retried up to "max_retries"
+# times, each time doubling the tolerance (up to "max_tol")
+# and increasing the timeout by half again, to give the
+# solver room to converge.  So the tolerance returned may be
+# looser than the one asked for.
+#--------------------------------------------------------------
+
+def run_fastercap(file, tolerance, verbose=0, max_tol=0.2, max_retries=5):
+    loctol = tolerance
+    timeout = 30
+    print('Running FasterCap on input file ' + file)
+    for attempt in range(max_retries):
+        try:
+            result = stream_fastercap(fastercap_command(file, loctol), timeout, verbose)
+        except subprocess.TimeoutExpired:
+            loctol = min(loctol * 2, max_tol)
+            timeout = int(timeout * 1.5)
+            if verbose > 0 and attempt < max_retries - 1:
+                print('Trying again with tolerance = ' + '{:.3f}'.format(loctol)
+			+ ' and timeout = ' + str(timeout) + 's')
+        else:
+            check_tolerance(loctol)
+            return fastercap_result(*result), loctol, result[2]
+
+    print('ERROR:  FasterCap timed out ' + str(max_retries) + ' times;  bailing.')
+    return None, loctol, None
+
+async def run_fastercap_async(file, tolerance, verbose=0, max_tol=0.2, max_retries=5):
+    loctol = tolerance
+    timeout = 30
+    print('Running FasterCap on input file ' + file)
+    for attempt in range(max_retries):
+        try:
+            result = await stream_fastercap_async(fastercap_command(file, loctol), timeout, verbose)
+        except subprocess.TimeoutExpired:
+            loctol = min(loctol * 2, max_tol)
+            timeout = int(timeout * 1.5)
+            if verbose > 0 and attempt < max_retries - 1:
+                print('Trying again with tolerance = ' + '{:.3f}'.format(loctol)
+			+ ' and timeout = ' + str(timeout) + 's')
+        else:
+            check_tolerance(loctol)
+            return fastercap_result(*result), loctol, result[2]
+
+    print('ERROR:  FasterCap timed out ' + str(max_retries) + ' times;  bailing.')
+    return None, loctol, None
+
+#--------------------------------------------------------------
+# Return a hash of the geometry described by FasterCap input
+# file "file".  Comment lines are ignored, and the names of
+# conductors and dielectric boundaries are replaced by their
+# order of appearance, so that two files that differ only in
+# layer names (e.g., a wire over "subs" and the same wire over
+# "nwell" at the same height) have the same hash.  Such files
+# give the same capacitance matrix.
+#--------------------------------------------------------------
+
+def geometry_hash(file):
+    names = {}
+    ghash = hashlib.blake2b()
+    with open(file, 'r') as ifile:
+        for line in ifile:
+            if line.startswith('*'):
+                continue
+            tokens = line.split()
+            if len(tokens) > 1 and tokens[0] in ('C', 'D', 'File'):
+                tokens[1] = names.setdefault(tokens[1], str(len(names)))
+            ghash.update((' '.join(tokens) + '\n').encode())
+    return ghash.hexdigest()
+
+#--------------------------------------------------------------
+# Result cache.  The cache database is kept in the same
+# directory as the input file.  The requested tolerance is
+# part of the key, rounded as for the FasterCap command line,
+# so that values such as 0.01 and 0.0100001 share one entry.
+# The tolerance FasterCap ended up running at (which is looser
+# if it timed out and was retried) is stored with the result.
+# cache_lookup() returns the cache database name, the key for
+# the input file, and the cached capacitance matrix (or None
+# if not cached) with the tolerance it was found at.  If the
+# geometry hash of the file is already known, it may be passed
+# as "ghash".
+#--------------------------------------------------------------
+
+def cache_lookup(file, tolerance, ghash=None):
+    if not ghash:
+        ghash = geometry_hash(file)
+    key = ghash + '_' + "{:.3f}".format(tolerance)
+
+    cachefile = os.path.join(os.path.split(file)[0], '.cache.db')
+
+    db = sqlite3.connect(cachefile, timeout=60)
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS matrices '
+			'(key TEXT PRIMARY KEY, tolerance REAL, gmatrix TEXT)')
+        row = db.execute('SELECT tolerance, gmatrix FROM matrices WHERE key = ?',
+			(key,)).fetchone()
+    finally:
+        db.close()
+
+    if not row:
+        return cachefile, key, None, tolerance
+    return cachefile, key, json.loads(row[1]), row[0]
+
+def cache_store(cachefile, key, gmatrix, loctol):
+    db = sqlite3.connect(cachefile, timeout=60)
+    try:
+        with db:
+            db.execute('INSERT OR REPLACE INTO matrices VALUES (?, ?, ?)',
+			(key, loctol, json.dumps(gmatrix)))
+    finally:
+        db.close()
+
+#--------------------------------------------------------------
+# Memoized versions of run_fastercap() and run_fastercap_async().
+# Only results from runs where FasterCap exited normally are
+# stored, since a run that crashed or was killed may have
+# printed only an intermediate matrix (such a matrix is still
+# returned for the current run).  Results are stored with the
+# tolerance FasterCap actually ran at, so that a result found
+# only after loosening the tolerance still gets a warning when
+# it is read back from the cache.  In the asyncio version, the
+# cache database is read and written from a worker thread,
+# since waiting on a database lock held by another process
+# would otherwise stall all of the other FasterCap runs.
+#--------------------------------------------------------------
+
+def memoize_fastercap(file, tolerance, verbose=0):
+    cachefile, key, gmatrix, loctol = cache_lookup(file, tolerance)
+    if gmatrix:
+        if verbose > 0:
+            print('Using cached FasterCap result for input file ' + file)
+        check_tolerance(loctol)
+        return gmatrix
+
+    gmatrix, loctol, returncode = run_fastercap(file, tolerance, verbose)
+    if gmatrix and returncode == 0:
+        cache_store(cachefile, key, gmatrix, loctol)
+    return gmatrix
+
+async def memoize_fastercap_async(file, tolerance, verbose=0, ghash=None):
+    cachefile, key, gmatrix, loctol = await asyncio.to_thread(cache_lookup, file,
+			tolerance, ghash)
+    if gmatrix:
+        if verbose > 0:
+            print('Using cached FasterCap result for input file ' + file)
+        check_tolerance(loctol)
+        return gmatrix
+
+    gmatrix, loctol, returncode = await run_fastercap_async(file, tolerance, verbose)
+    if gmatrix and returncode == 0:
+        await asyncio.to_thread(cache_store, cachefile, key, gmatrix, loctol)
+    return gmatrix
+
+#--------------------------------------------------------------
+# Return the number of FasterCap processes to run at once for
+# a batch of "njobs" runs.  This is one per CPU, but no more
+# than the number of runs, and no more than fit in available
+# memory (see fastercap_memory).  FasterCap is memory-bound,
+# and runs that compete for memory bandwidth or swap can each
+# be slower than running fewer of them at a time.  If the
+# environment variable CAPICHE_JOBS is set, it is used instead.
+#--------------------------------------------------------------
+
+def fastercap_jobs(njobs):
+    envjobs = os.getenv('CAPICHE_JOBS')
+    if envjobs:
+        try:
+            return max(1, int(envjobs))
+        except:
+            print('Warning:  CAPICHE_JOBS value "' + envjobs + '" is not numeric.')
+
+    maxjobs = min(os.cpu_count() or 1, njobs)
+
+    # Available memory is only known on Linux;  elsewhere, there is
+    # no limit on memory.
+    try:
+        with open('/proc/meminfo', 'r') as ifile:
+            for line in ifile:
+                if line.startswith('MemAvailable:'):
+                    availmem = int(line.split()[1]) * 1024
+                    maxjobs = min(maxjobs, availmem // fastercap_memory)
+                    break
+    except:
+        pass
+
+    return max(1, maxjobs)
+
+#--------------------------------------------------------------
+# Run FasterCap (memoized) on every file in "filelist", with
+# up to "maxjobs" (default from fastercap_jobs()) FasterCap
+# processes running at once, all overseen by asyncio from the
+# calling process, so there is no worker pool to start up or
+# tear down.  Files that describe the same geometry (see
+# geometry_hash()) are only run once.  If "sizes" is given,
+# it is a list of the relative cost of each file (e.g., wire
+# width), and the largest jobs are started first.
+#
+# If "callback" is given, then callback(i, gmatrix) is called
+# for the i-th file of "filelist" as soon as its result is
+# known, so that results can be saved while the rest are still
+# running.  Note that results do not finish in file order.
+#
+# Returns a list of capacitance matrices (or None for each
+# failed run) in the order of "filelist".
+#--------------------------------------------------------------
+
+def run_fastercap_batch(filelist, tolerance, verbose=0, sizes=None, maxjobs=None, callback=None):
+    ghashes = [geometry_hash(file) for file in filelist]
+    runlist = []
+    runhashes = []
+    runsizes = []
+    runfiles = []
+    runindex = {}
+    for i, file in enumerate(filelist):
+        ghash = ghashes[i]
+        if ghash not in runindex:
+            runindex[ghash] = len(runlist)
+            runlist.append(file)
+            runhashes.append(ghash)
+            runsizes.append(sizes[i] if sizes else 0)
+            runfiles.append([])
+        elif verbose > 0:
+            print('Input file ' + file + ' has the same geometry as ' + runlist[runindex[ghash]])
+        runfiles[runindex[ghash]].append(i)
+
+    async def run_one(index, semaphore):
+        async with semaphore:
+            gmatrix = await memoize_fastercap_async(runlist[index], tolerance, verbose,
+			runhashes[index])
+        if callback:
+            for i in runfiles[index]:
+                callback(i, gmatrix)
+        return gmatrix
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(maxjobs if maxjobs else fastercap_jobs(len(runlist)))
+        order = sorted(range(len(runlist)), key=lambda i: runsizes[i], reverse=True)
+        tasks = [None] * len(runlist)
+        for i in order:
+            tasks[i] = asyncio.create_task(run_one(i, semaphore))
+        return await asyncio.gather(*tasks)
+
+    gmatrices = asyncio.run(run_all())
+    return [gmatrices[runindex[ghash]] for ghash in ghashes]
+
+#--------------------------------------------------------------
+# Return the largest difference between the capacitance
+# matrices "gmatrix" and "gref", relative to the largest value
+# in "gref".
+#--------------------------------------------------------------
+
+def gmatrix_error(gmatrix, gref):
+    scale = max(abs(value) for row in gref for value in row)
+    if scale == 0:
+        return 0
+    diff = max(abs(value - vref) for row, rowref in zip(gmatrix, gref)
+		for value, vref in zip(row, rowref))
+    return diff / scale
+
+#--------------------------------------------------------------
+# Adaptive-tolerance version of run_fastercap_batch().  FasterCap
+# run time goes up steeply as the tolerance is tightened, and
+# most geometries in a sweep do not need the tight tolerance.
+# So every file is first run at the loose tolerance "loosetol",
+# and then only some files are re-run at "tolerance".
+#
+# The files are divided into groups given by "groups" (one group
+# key per file, e.g., one group for each metal and conductor
+# pair over a sweep of wire widths), ordered by "sizes".  In
+# each group, these files are re-run at "tolerance":
+#
+#   (1) The middle file of the group, to check the group.
+#   (2) Any file whose loose result is not within "loosetol"
+#	of the result interpolated from the files on either
+#	side of it in the group.
+#   (3) Any file that failed at the loose tolerance.
+#
+# If the check file of a group does not agree with its loose
+# result to within "loosetol", the whole group is re-run at
+# "tolerance".  Otherwise the loose results stand for the rest
+# of the group.
+#
+# "callback" is as for run_fastercap_batch(), but is called
+# only with the final results.
+#
+# Returns a list of capacitance matrices (or None for each
+# failed run) in the order of "filelist".
+#--------------------------------------------------------------
+
+def run_fastercap_adaptive(filelist, groups, tolerance, loosetol, verbose=0, sizes=None, callback=None):
+    if loosetol <= tolerance:
+        return run_fastercap_batch(filelist, tolerance, verbose, sizes, callback=callback)
+
+    if not sizes:
+        sizes = [0] * len(filelist)
+
+    loose = run_fastercap_batch(filelist, loosetol, verbose, sizes)
+    gmatrices = loose.copy()
+
+    members = {}
+    for i, group in enumerate(groups):
+        members.setdefault(group, []).append(i)
+
+    # Find the files to re-run:  first the check files and
+    # suspect results, then the rest of any group that fails
+    # its check.
+
+    checks = {}
+    rerun = set()
+    for group, indices in members.items():
+        indices.sort(key=lambda i: sizes[i])
+        rerun.update(i for i in indices if not loose[i])
+        valid = [i for i in indices if loose[i]]
+        if not valid:
+            continue
+        checks[group] = valid[len(valid) // 2]
+        rerun.add(checks[group])
+        for prev, i, next in zip(valid, valid[1:], valid[2:]):
+            if sizes[next] == sizes[prev]:
+                continue
+            frac = (sizes[i] - sizes[prev]) / (sizes[next] - sizes[prev])
+            expected = [[vprev + (vnext - vprev) * frac for vprev, vnext in zip(rprev, rnext)]
+			for rprev, rnext in zip(loose[prev], loose[next])]
+            if gmatrix_error(loose[i], expected) > loosetol:
+                if verbose > 0:
+                    print('Result for input file ' + filelist[i] + ' is out of line with its neighbors.')
+                rerun.add(i)
+
+    for npass in range(2):
+        runlist = sorted(rerun)
+        if verbose > 0:
+            print('Re-running ' + str(len(runlist)) + ' of ' + str(len(filelist))
+			+ ' files with tolerance = ' + '{:.3f}'.format(tolerance))
+        tight = run_fastercap_batch([filelist[i] for i in runlist], tolerance, verbose,
+			[sizes[i] for i in runlist])
+        for i, gmatrix in zip(runlist, tight):
+            if gmatrix:
+                gmatrices[i] = gmatrix
+
+        if npass > 0:
+            break
+
+        rerun = set()
+        for group, i in checks.items():
+            if gmatrices[i] is loose[i] or gmatrix_error(loose[i], gmatrices[i]) > loosetol:
+                if verbose > 0:
+                    print('Check of input file ' + filelist[i] + ' failed;  re-running its group.')
+                rerun.update(j for j in members[group] if gmatrices[j] is loose[j])
+        if not rerun:
+            break
+
+    if callback:
+        for i, gmatrix in enumerate(gmatrices):
+            callback(i, gmatrix)
+
+    return gmatrices
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+#
+# sweep_range.py --
+#
+#	Generate the values for a width or separation sweep.
+#
+import numpy
+
+#--------------------------------------------------------------
+# Return the same set of values as numpy.arange(start, stop,
+# step), i.e., from "start" up to but not including "stop".
+# The number of points is computed once with a small
+# allowance for rounding, and the values are generated with
+# numpy.linspace(), so that floating-point error in the step
+# cannot add a spurious point at the end of the range.
+# "step" may be negative.
+#--------------------------------------------------------------
+
+def sweep_range(start, stop, step):
+    npoints = int(numpy.ceil((stop - start) / step - 1e-6))
+    if npoints <= 0:
+        return numpy.array([])
+    return numpy.linspace(start, start + (npoints - 1) * step, npoints)